@@ -6,4 +6,16 @@ SSH_PASS = 'Your Password'
 
 DB_USER = 'DB user'                
 DB_PASS = 'DB password'
-DB_NAME = 'Your DB Name'
\ No newline at end of file
+DB_NAME = 'Your DB Name'
+
+
+# Optional: connection pool (one per process)
+DB_POOL_SIZE = 5
+DB_POOL_TIMEOUT = 10
+
+# Optional: health checks
+HEALTH_READY_TIMEOUT = 2
+HEALTH_STATS_CACHE_SECONDS = 300
+
+# Optional: per-query time limit (seconds) for the gunicorn workers
+DB_QUERY_TIMEOUT = 30
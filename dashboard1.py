@@ -1,68 +1,62 @@
-from flask import Flask, jsonify, render_template
-from datetime import datetime
-import mysql.connector
+from flask import Flask, jsonify, render_template, request
+from datetime import datetime, date
+import base64
+import binascii
+import json
+import os
 from mysql.connector import Error
-from sshtunnel import SSHTunnelForwarder
 from flask_cors import CORS
 from decimal import Decimal
 
-from config.constants import (
-    SSH_HOST, SSH_PORT, SSH_USER, SSH_PASS,
-    DB_USER, DB_PASS, DB_NAME
-)
+import profiler
+from db import get_db_connection, get_direct_connection, resolve_as_of, STATEMENTS, ColumnResult
+from feature_store import FeatureStore, DEFAULT_RISK_MODEL, merge_model, risk_level
+from health import health
 
 app = Flask(__name__)
 CORS(app)
+app.register_blueprint(health)
 
-def get_db_connection():
-    server = SSHTunnelForwarder(
-        ssh_address_or_host=(SSH_HOST,SSH_PORT ), 
-        ssh_username=SSH_USER,                   
-        ssh_password=SSH_PASS,                
-        remote_bind_address=('localhost', 3306)     
-    )
-
-    server.start()    
-    conn=  mysql.connector.connect(
-        host='localhost',              
-        port=server.local_bind_port,   
-        user=DB_USER,                
-        password=DB_PASS,        
-        database= DB_NAME        
-    )
-    return conn
-
-def query_database(query, params=None):
+def convert_rows(results):
+    for row in results:
+        for key, value in row.items():
+            if isinstance(value, Decimal):
+                row[key] = float(value)
+            elif isinstance(value, datetime):
+                row[key] = value.isoformat()
+    return results
+
+def query_statement(name, params=()):
     """
-    Execute database query with MySQL connection
+    Execute a registered (prepared) statement by name. Errors are logged and
+    re-raised: an empty result would otherwise be served (and cached) as real data
     """
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
     try:
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        
-        for row in results:
-            for key, value in row.items():
-                if isinstance(value, Decimal):
-                    row[key] = float(value)
-                elif isinstance(value, datetime):
-                    row[key] = value.isoformat()
-        
-        return results
+        return convert_rows(STATEMENTS.execute(name, params))
     except Exception as e:
         print(f"Database error: {e}")
-        print(f"Query: {query}")
+        print(f"Statement: {name}")
         print(f"Params: {params}")
-        return []
-    finally:
-        cursor.close()
-        conn.close()
+        raise
+
+def query_statement_columns(name, params=()):
+    """
+    Execute a registered statement into a column-oriented result, for large
+    detail sets: rows are read as tuples in batches and converted per column
+    """
+    try:
+        return STATEMENTS.execute_columns(name, params)
+    except Exception as e:
+        print(f"Database error: {e}")
+        print(f"Statement: {name}")
+        print(f"Params: {params}")
+        raise
 
 
 
 @app.route('/api/diagnose/<int:patient_id>')
 def diagnose_patient(patient_id):
+    conn = cursor = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
@@ -168,9 +162,6 @@ def diagnose_patient(patient_id):
         counts = cursor.fetchone()
         report['field_analysis']['record_counts'] = counts
         
-        cursor.close()
-        conn.close()
-        
         return jsonify(report)
         
     except Exception as e:
@@ -179,10 +170,15 @@ def diagnose_patient(patient_id):
             'error': str(e),
             'traceback': traceback.format_exc()
         }), 500
+    finally:
+        # Pooled connection: give it back on the error path too
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
 
 
-def get_patient_data(patient_id):
-    demographics_query = """
+STATEMENTS.register('dashboard1.demographics', """
     SELECT 
         e.patient_id,
         COALESCE(MAX(e.age_in_years), 0) as age,
@@ -193,14 +189,14 @@ def get_patient_data(patient_id):
     FROM hf_encounter e
     WHERE e.patient_id = %s
     GROUP BY e.patient_id
-    """
-    
-    opioid_summary_query = """
+    """)
+
+STATEMENTS.register('dashboard1.opioid_summary', """
     SELECT 
         COALESCE(COUNT(DISTINCT m.medication_row_id), 0) as total_prescriptions,
         COALESCE(COUNT(DISTINCT m.generic_name), 0) as unique_opioid_types,
-        COALESCE(SUM(CASE WHEN m.med_started_dt_tm >= DATE_SUB(NOW(), INTERVAL 30 DAY) THEN 1 ELSE 0 END), 0) as rx_last_30_days,
-        COALESCE(SUM(CASE WHEN m.med_started_dt_tm >= DATE_SUB(NOW(), INTERVAL 90 DAY) THEN 1 ELSE 0 END), 0) as rx_last_90_days
+        COALESCE(SUM(CASE WHEN m.med_started_dt_tm >= DATE_SUB(%s, INTERVAL 30 DAY) THEN 1 ELSE 0 END), 0) as rx_last_30_days,
+        COALESCE(SUM(CASE WHEN m.med_started_dt_tm >= DATE_SUB(%s, INTERVAL 90 DAY) THEN 1 ELSE 0 END), 0) as rx_last_90_days
     FROM hf_medication m
     JOIN hf_encounter e ON m.encounter_id = e.encounter_id
     WHERE e.patient_id = %s
@@ -210,9 +206,9 @@ def get_patient_data(patient_id):
              OR LOWER(COALESCE(m.generic_name, '')) LIKE '%fentanyl%'
              OR LOWER(COALESCE(m.generic_name, '')) LIKE '%codeine%' 
              OR LOWER(COALESCE(m.generic_name, '')) LIKE '%tramadol%')
-    """
-    
-    opioid_details_query = """
+    """)
+
+STATEMENTS.register('dashboard1.opioid_details', """
     SELECT 
         m.medication_row_id,
         m.encounter_id,
@@ -222,7 +218,7 @@ def get_patient_data(patient_id):
         m.med_stopped_dt_tm as stop_date,
         COALESCE(m.duration_minutes, 0) as duration_minutes,
         COALESCE(m.frequency_desc, 'N/A') as frequency,
-        COALESCE(DATEDIFF(NOW(), m.med_started_dt_tm), 0) as days_since_prescribed,
+        COALESCE(DATEDIFF(%s, m.med_started_dt_tm), 0) as days_since_prescribed,
         CASE 
             WHEN COALESCE(m.duration_minutes, 0) < 1440 THEN 'Short (<1 day)'
             WHEN COALESCE(m.duration_minutes, 0) < 10080 THEN 'Medium (1-7 days)'
@@ -243,9 +239,9 @@ def get_patient_data(patient_id):
              OR LOWER(COALESCE(m.generic_name, '')) LIKE '%codeine%' 
              OR LOWER(COALESCE(m.generic_name, '')) LIKE '%tramadol%')
     ORDER BY m.med_started_dt_tm DESC
-    """
-    
-    diagnosis_summary_query = """
+    """)
+
+STATEMENTS.register('dashboard1.diagnosis_summary', """
     SELECT 
         COALESCE(COUNT(DISTINCT d.diagnosis_row_id), 0) as total_diagnoses,
         COALESCE(SUM(CASE WHEN d.diagnosis_icd LIKE 'F11%' OR d.diagnosis_icd LIKE 'T40%' THEN 1 ELSE 0 END), 0) as opioid_dx,
@@ -254,9 +250,9 @@ def get_patient_data(patient_id):
     FROM hf_diagnosis d
     JOIN hf_encounter e ON d.encounter_id = e.encounter_id
     WHERE e.patient_id = %s
-    """
-    
-    diagnosis_details_query = """
+    """)
+
+STATEMENTS.register('dashboard1.diagnosis_details', """
     SELECT 
         d.diagnosis_row_id,
         d.encounter_id,
@@ -276,10 +272,9 @@ def get_patient_data(patient_id):
     JOIN hf_encounter e ON d.encounter_id = e.encounter_id
     WHERE e.patient_id = %s
     ORDER BY e.admitted_dt_tm DESC
-    """
-    
-    
-    encounter_summary_query = """
+    """)
+
+STATEMENTS.register('dashboard1.encounter_summary', """
     SELECT 
         COALESCE(COUNT(DISTINCT e.encounter_id), 0) as total_encounters,
         COALESCE(SUM(CASE WHEN LOWER(COALESCE(e.patient_type_desc, '')) LIKE '%emergency%' THEN 1 ELSE 0 END), 0) as ed_visits,
@@ -287,10 +282,9 @@ def get_patient_data(patient_id):
         COALESCE(AVG(DATEDIFF(e.discharged_dt_tm, e.admitted_dt_tm)), 0) as avg_los
     FROM hf_encounter e
     WHERE e.patient_id = %s
-    """
-    
-   
-    encounter_details_query = """
+    """)
+
+STATEMENTS.register('dashboard1.encounter_details', """
     SELECT 
         e.encounter_id,
         e.admitted_dt_tm as admission_date,
@@ -303,90 +297,238 @@ def get_patient_data(patient_id):
     FROM hf_encounter e
     WHERE e.patient_id = %s
     ORDER BY e.admitted_dt_tm DESC
-    """
-    
-    
-    demographics = query_database(demographics_query, (patient_id,))
-    opioid_summary = query_database(opioid_summary_query, (patient_id,))
-    opioid_details = query_database(opioid_details_query, (patient_id,))
-    diagnosis_summary = query_database(diagnosis_summary_query, (patient_id,))
-    diagnosis_details = query_database(diagnosis_details_query, (patient_id,))
-    encounter_summary = query_database(encounter_summary_query, (patient_id,))
-    encounter_details = query_database(encounter_details_query, (patient_id,))
+    """)
+
+
+# Keyset (seek) pages of the detail queries: same rows and order as above, continuing
+# after the (date, id) key of the previous page. The seek compares the raw columns so
+# the (patient_id, date) index can serve it; rows without a date sort last, as they
+# do in the unpaged queries, and are paged afterwards by id from `<name>_nulls`.
+def register_detail_pages(name, sql, date_column, id_column):
+    STATEMENTS.register(name, sql + f"""
+        AND ({date_column} < %s OR ({date_column} = %s AND {id_column} < %s))
+    ORDER BY {date_column} DESC, {id_column} DESC
+    LIMIT %s
+    """)
+    STATEMENTS.register(name + '_nulls', sql + f"""
+        AND {date_column} IS NULL AND {id_column} < %s
+    ORDER BY {id_column} DESC
+    LIMIT %s
+    """)
+
+
+register_detail_pages('dashboard1.opioid_details_page', """
+    SELECT 
+        m.medication_row_id,
+        m.encounter_id,
+        COALESCE(m.generic_name, 'Unknown') as medication_name,
+        COALESCE(m.order_strength, 'N/A') as strength,
+        m.med_started_dt_tm as start_date,
+        m.med_stopped_dt_tm as stop_date,
+        COALESCE(m.duration_minutes, 0) as duration_minutes,
+        COALESCE(m.frequency_desc, 'N/A') as frequency,
+        COALESCE(DATEDIFF(%s, m.med_started_dt_tm), 0) as days_since_prescribed,
+        CASE 
+            WHEN COALESCE(m.duration_minutes, 0) < 1440 THEN 'Short (<1 day)'
+            WHEN COALESCE(m.duration_minutes, 0) < 10080 THEN 'Medium (1-7 days)'
+            ELSE 'Long (>7 days)'
+        END as duration_category,
+        CASE
+            WHEN LOWER(COALESCE(m.generic_name, '')) LIKE '%fentanyl%' OR LOWER(COALESCE(m.generic_name, '')) LIKE '%morphine%' THEN 'High Potency'
+            WHEN LOWER(COALESCE(m.generic_name, '')) LIKE '%oxycodone%' OR LOWER(COALESCE(m.generic_name, '')) LIKE '%hydrocodone%' THEN 'Medium Potency'
+            ELSE 'Low Potency'
+        END as potency_level
+    FROM hf_medication m
+    JOIN hf_encounter e ON m.encounter_id = e.encounter_id
+    WHERE e.patient_id = %s
+        AND (LOWER(COALESCE(m.generic_name, '')) LIKE '%oxycodone%' 
+             OR LOWER(COALESCE(m.generic_name, '')) LIKE '%hydrocodone%'
+             OR LOWER(COALESCE(m.generic_name, '')) LIKE '%morphine%' 
+             OR LOWER(COALESCE(m.generic_name, '')) LIKE '%fentanyl%'
+             OR LOWER(COALESCE(m.generic_name, '')) LIKE '%codeine%' 
+             OR LOWER(COALESCE(m.generic_name, '')) LIKE '%tramadol%')""",
+    'm.med_started_dt_tm', 'm.medication_row_id')
+
+register_detail_pages('dashboard1.diagnosis_details_page', """
+    SELECT 
+        d.diagnosis_row_id,
+        d.encounter_id,
+        COALESCE(d.diagnosis_icd, 'Unknown') as diagnosis_code,
+        COALESCE(d.diagnosis_description, 'Unknown') as diagnosis_description,
+        COALESCE(d.diagnosis_priority, 0) as diagnosis_priority,
+        COALESCE(d.diagnosis_type, 'Unknown') as diagnosis_type,
+        e.admitted_dt_tm as diagnosis_date,
+        CASE 
+            WHEN d.diagnosis_icd LIKE 'F11%' THEN 'Opioid Use'
+            WHEN d.diagnosis_icd LIKE 'T40%' THEN 'Opioid Poisoning'
+            WHEN d.diagnosis_icd LIKE 'F1%' THEN 'Substance Use'
+            WHEN d.diagnosis_icd LIKE 'M%' THEN 'Pain'
+            ELSE 'Other'
+        END as diagnosis_category
+    FROM hf_diagnosis d
+    JOIN hf_encounter e ON d.encounter_id = e.encounter_id
+    WHERE e.patient_id = %s""",
+    'e.admitted_dt_tm', 'd.diagnosis_row_id')
+
+register_detail_pages('dashboard1.encounter_details_page', """
+    SELECT 
+        e.encounter_id,
+        e.admitted_dt_tm as admission_date,
+        e.discharged_dt_tm as discharge_date,
+        COALESCE(DATEDIFF(e.discharged_dt_tm, e.admitted_dt_tm), 0) as length_of_stay_days,
+        COALESCE(e.patient_type_desc, 'Unknown') as encounter_type,
+        COALESCE(e.dischg_disp_code_desc, 'Unknown') as discharge_disposition,
+        COALESCE(e.caresetting_desc, 'Unknown') as care_setting,
+        COALESCE(e.payer_code_desc, 'Unknown') as payer
+    FROM hf_encounter e
+    WHERE e.patient_id = %s""",
+    'e.admitted_dt_tm', 'e.encounter_id')
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# Seek key of the first page (before every row). A key with a date of None continues
+# in the trailing phase of rows without a date.
+FIRST_PAGE_KEY = (datetime(9999, 12, 31, 23, 59, 59), 2 ** 63 - 1)
+
+# section -> (statement, date column, id column); statement + '_nulls' pages the undated rows
+DETAIL_PAGES = {
+    'opioids': ('dashboard1.opioid_details_page', 'start_date', 'medication_row_id'),
+    'diagnoses': ('dashboard1.diagnosis_details_page', 'diagnosis_date', 'diagnosis_row_id'),
+    'encounters': ('dashboard1.encounter_details_page', 'admission_date', 'encounter_id'),
+}
+
+
+def encode_page_cursor(section, key_date, key_id):
+    """key_date is an ISO string, or None for a position among the rows without a date"""
+    payload = json.dumps([section, key_date, key_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_page_cursor(section, token):
+    """(date, id) seek key from an opaque cursor token; ValueError if it is not one of ours"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        token_section, key_date, key_id = json.loads(base64.urlsafe_b64decode(padded))
+        key = (None if key_date is None else datetime.fromisoformat(key_date), int(key_id))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if token_section != section:
+        raise ValueError('Cursor belongs to a different section')
+    return key
+
+
+def get_detail_page(patient_id, section, cursor=None, limit=DEFAULT_PAGE_SIZE, as_of=None):
+    """One page of a detail section plus the cursor of the next page (None on the last page)"""
+    statement, date_column, id_column = DETAIL_PAGES[section]
+    key_date, key_id = decode_page_cursor(section, cursor) if cursor else FIRST_PAGE_KEY
+    prefix = (resolve_as_of(as_of),) if section == 'opioids' else ()
+
+    rows = ColumnResult()
+    if key_date is not None:
+        rows = query_statement_columns(statement, prefix + (patient_id, key_date, key_date, key_id, limit + 1))
+        if len(rows) <= limit:
+            # Dated rows ran out: fill the rest of the page from the rows without a date
+            key_date, key_id = None, FIRST_PAGE_KEY[1]
+    if key_date is None:
+        undated = query_statement_columns(statement + '_nulls', prefix + (patient_id, key_id, limit + 1 - len(rows)))
+        if not len(rows):
+            rows = undated
+        elif len(undated):
+            rows = ColumnResult(rows.columns, [values + more for values, more in zip(rows.data, undated.data)])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_page_cursor(section, last[date_column], last[id_column])
+    return rows, next_cursor
+
+
+def get_patient_summary(patient_id, as_of=None):
+    as_of = resolve_as_of(as_of)
+
+    demographics = query_statement('dashboard1.demographics', (patient_id,))
+    opioid_summary = query_statement('dashboard1.opioid_summary', (as_of, as_of, patient_id))
+    diagnosis_summary = query_statement('dashboard1.diagnosis_summary', (patient_id,))
+    encounter_summary = query_statement('dashboard1.encounter_summary', (patient_id,))
     
    
     risk = calculate_risk(opioid_summary[0] if opioid_summary else {},
                          diagnosis_summary[0] if diagnosis_summary else {},
-                         encounter_summary[0] if encounter_summary else {})
+                         encounter_summary[0] if encounter_summary else {},
+                         as_of)
     
     return {
         'patient_id': patient_id,
+        'as_of': as_of.isoformat(),
         'demographics': demographics[0] if demographics else {},
         'opioid_summary': opioid_summary[0] if opioid_summary else {},
-        'opioid_details': opioid_details,
         'diagnosis_summary': diagnosis_summary[0] if diagnosis_summary else {},
-        'diagnosis_details': diagnosis_details,
         'encounter_summary': encounter_summary[0] if encounter_summary else {},
-        'encounter_details': encounter_details,
         'risk_score': risk
     }
 
 
-def calculate_risk(opioid, diagnosis, encounter):
-    """Calculate risk score 0 to 100"""
+def get_patient_data(patient_id, as_of=None):
+    as_of = resolve_as_of(as_of)
+
+    data = get_patient_summary(patient_id, as_of)
+    data['opioid_details'] = query_statement_columns('dashboard1.opioid_details', (as_of, patient_id))
+    data['diagnosis_details'] = query_statement_columns('dashboard1.diagnosis_details', (patient_id,))
+    data['encounter_details'] = query_statement_columns('dashboard1.encounter_details', (patient_id,))
+    return data
+
+
+def calculate_risk(opioid, diagnosis, encounter, as_of=None, model=DEFAULT_RISK_MODEL):
+    """Calculate risk score 0 to 100 as of the given day (the summaries must be evaluated on the same day)"""
+    as_of = resolve_as_of(as_of)
+    weights = model['weights']
+    thresholds = model['thresholds']
     score = 0
     factors = []
     
     total_rx = opioid.get('total_prescriptions', 0) or 0
-    if total_rx >= 10:
-        score += 20
+    if total_rx >= thresholds['high_rx']:
+        score += weights['high_rx']
         factors.append('High Prescription Count')
-    elif total_rx >= 5:
-        score += 10
+    elif total_rx >= thresholds['moderate_rx']:
+        score += weights['moderate_rx']
     
     recent_rx = opioid.get('rx_last_30_days', 0) or 0
-    if recent_rx >= 2:
-        score += 15
+    if recent_rx >= thresholds['recent_rx']:
+        score += weights['recent_rx']
         factors.append('Recent Prescriptions')
     
-    if (diagnosis.get('opioid_dx', 0) or 0) > 0:
-        score += 30
+    if (diagnosis.get('opioid_dx', 0) or 0) >= thresholds['opioid_dx']:
+        score += weights['opioid_dx']
         factors.append('Opioid Use Disorder')
     
-    if (diagnosis.get('substance_dx', 0) or 0) > 0:
-        score += 15
+    if (diagnosis.get('substance_dx', 0) or 0) >= thresholds['substance_dx']:
+        score += weights['substance_dx']
         factors.append('Substance Use History')
     
     ed_visits = encounter.get('ed_visits', 0) or 0
-    if ed_visits >= 3:
-        score += 10
+    if ed_visits >= thresholds['frequent_ed']:
+        score += weights['frequent_ed']
         factors.append('Frequent ED Visits')
     
-    if score >= 60:
-        level = 'CRITICAL'
-    elif score >= 40:
-        level = 'HIGH'
-    elif score >= 20:
-        level = 'MODERATE'
-    else:
-        level = 'LOW'
+    level = risk_level(score, model)
     
-    return {'score': min(score, 100), 'level': level, 'factors': factors}
+    return {'score': min(score, 100), 'level': level, 'factors': factors, 'as_of': as_of.isoformat()}
 
 
-def flatten_for_tableau(patient_data):
-    rows = []
-    patient_id = patient_data['patient_id']
-    
-    def safe(data, key, default=None):
-        value = data.get(key, default)
-        return value if value is not None else default
-    
+def safe(data, key, default=None):
+    value = data.get(key, default)
+    return value if value is not None else default
+
+
+def tableau_base(patient_data):
     demo = patient_data.get('demographics', {})
     risk = patient_data.get('risk_score', {})
     
-    base = {
-        'patient_id': patient_id,
+    return {
+        'patient_id': patient_data['patient_id'],
         'age': safe(demo, 'age', 0),
         'gender': safe(demo, 'gender', 'Unknown'),
         'race': safe(demo, 'race', 'Unknown'),
@@ -396,66 +538,80 @@ def flatten_for_tableau(patient_data):
         'risk_level': safe(risk, 'level', 'LOW'),
         'risk_factors': ', '.join(risk.get('factors', []))
     }
-    
-   
-    for med in patient_data.get('opioid_details', []):
-        row = base.copy()
-        row.update({
-            'data_type': 'Medication',
-            'medication_name': safe(med, 'medication_name', 'Unknown'),
-            'strength': safe(med, 'strength', 'N/A'),
-            'start_date': safe(med, 'start_date'),
-            'stop_date': safe(med, 'stop_date'),
-            'duration_minutes': safe(med, 'duration_minutes', 0),
-            'frequency': safe(med, 'frequency', 'N/A'),
-            'days_since_prescribed': safe(med, 'days_since_prescribed', 0),
-            'duration_category': safe(med, 'duration_category', 'Unknown'),
-            'potency_level': safe(med, 'potency_level', 'Unknown'),
-            'encounter_id': safe(med, 'encounter_id')
-        })
-        rows.append(row)
-    
-    for diag in patient_data.get('diagnosis_details', []):
-        row = base.copy()
-        row.update({
-            'data_type': 'Diagnosis',
-            'diagnosis_code': safe(diag, 'diagnosis_code', 'Unknown'),
-            'diagnosis_description': safe(diag, 'diagnosis_description', 'Unknown'),
-            'diagnosis_priority': safe(diag, 'diagnosis_priority', 0),
-            'diagnosis_type': safe(diag, 'diagnosis_type', 'Unknown'),
-            'diagnosis_category': safe(diag, 'diagnosis_category', 'Other'),
-            'diagnosis_date': safe(diag, 'diagnosis_date'),
-            'encounter_id': safe(diag, 'encounter_id')
-        })
-        rows.append(row)
-    
-    for enc in patient_data.get('encounter_details', []):
-        row = base.copy()
-        row.update({
-            'data_type': 'Encounter',
-            'encounter_id': safe(enc, 'encounter_id'),
-            'admission_date': safe(enc, 'admission_date'),
-            'discharge_date': safe(enc, 'discharge_date'),
-            'length_of_stay_days': safe(enc, 'length_of_stay_days', 0),
-            'encounter_type': safe(enc, 'encounter_type', 'Unknown'),
-            'patient_type': safe(enc, 'encounter_type', 'Unknown'),
-            'discharge_disposition': safe(enc, 'discharge_disposition', 'Unknown'),
-            'care_setting': safe(enc, 'care_setting', 'Unknown'),
-            'payer': safe(enc, 'payer', 'Unknown')
-        })
-        rows.append(row)
-    
+
+
+def medication_row(base, med):
+    row = base.copy()
+    row.update({
+        'data_type': 'Medication',
+        'medication_name': safe(med, 'medication_name', 'Unknown'),
+        'strength': safe(med, 'strength', 'N/A'),
+        'start_date': safe(med, 'start_date'),
+        'stop_date': safe(med, 'stop_date'),
+        'duration_minutes': safe(med, 'duration_minutes', 0),
+        'frequency': safe(med, 'frequency', 'N/A'),
+        'days_since_prescribed': safe(med, 'days_since_prescribed', 0),
+        'duration_category': safe(med, 'duration_category', 'Unknown'),
+        'potency_level': safe(med, 'potency_level', 'Unknown'),
+        'encounter_id': safe(med, 'encounter_id')
+    })
+    return row
+
+
+def diagnosis_row(base, diag):
+    row = base.copy()
+    row.update({
+        'data_type': 'Diagnosis',
+        'diagnosis_code': safe(diag, 'diagnosis_code', 'Unknown'),
+        'diagnosis_description': safe(diag, 'diagnosis_description', 'Unknown'),
+        'diagnosis_priority': safe(diag, 'diagnosis_priority', 0),
+        'diagnosis_type': safe(diag, 'diagnosis_type', 'Unknown'),
+        'diagnosis_category': safe(diag, 'diagnosis_category', 'Other'),
+        'diagnosis_date': safe(diag, 'diagnosis_date'),
+        'encounter_id': safe(diag, 'encounter_id')
+    })
+    return row
+
+
+def encounter_row(base, enc):
+    row = base.copy()
+    row.update({
+        'data_type': 'Encounter',
+        'encounter_id': safe(enc, 'encounter_id'),
+        'admission_date': safe(enc, 'admission_date'),
+        'discharge_date': safe(enc, 'discharge_date'),
+        'length_of_stay_days': safe(enc, 'length_of_stay_days', 0),
+        'encounter_type': safe(enc, 'encounter_type', 'Unknown'),
+        'patient_type': safe(enc, 'encounter_type', 'Unknown'),
+        'discharge_disposition': safe(enc, 'discharge_disposition', 'Unknown'),
+        'care_setting': safe(enc, 'care_setting', 'Unknown'),
+        'payer': safe(enc, 'payer', 'Unknown')
+    })
+    return row
+
+
+def summary_rows(base, patient_data):
     opioid_sum = patient_data.get('opioid_summary', {})
-    if opioid_sum and opioid_sum.get('total_prescriptions'):
-        row = base.copy()
-        row.update({
-            'data_type': 'Summary',
-            'total_prescriptions': safe(opioid_sum, 'total_prescriptions', 0),
-            'unique_opioid_types': safe(opioid_sum, 'unique_opioid_types', 0),
-            'rx_last_30_days': safe(opioid_sum, 'rx_last_30_days', 0),
-            'rx_last_90_days': safe(opioid_sum, 'rx_last_90_days', 0)
-        })
-        rows.append(row)
+    if not (opioid_sum and opioid_sum.get('total_prescriptions')):
+        return []
+    row = base.copy()
+    row.update({
+        'data_type': 'Summary',
+        'total_prescriptions': safe(opioid_sum, 'total_prescriptions', 0),
+        'unique_opioid_types': safe(opioid_sum, 'unique_opioid_types', 0),
+        'rx_last_30_days': safe(opioid_sum, 'rx_last_30_days', 0),
+        'rx_last_90_days': safe(opioid_sum, 'rx_last_90_days', 0)
+    })
+    return [row]
+
+
+def flatten_for_tableau(patient_data):
+    base = tableau_base(patient_data)
+    
+    rows = [medication_row(base, med) for med in patient_data.get('opioid_details', [])]
+    rows.extend(diagnosis_row(base, diag) for diag in patient_data.get('diagnosis_details', []))
+    rows.extend(encounter_row(base, enc) for enc in patient_data.get('encounter_details', []))
+    rows.extend(summary_rows(base, patient_data))
     
     if not rows:
         row = base.copy()
@@ -465,6 +621,13 @@ def flatten_for_tableau(patient_data):
     return rows
 
 
+PAGE_ROW_BUILDERS = {
+    'opioids': medication_row,
+    'diagnoses': diagnosis_row,
+    'encounters': encounter_row,
+}
+
+
 @app.route('/')
 def index():
     return render_template('dashboard1.html')
@@ -474,9 +637,21 @@ def index():
 @app.route('/api/tableau/patient/<int:patient_id>')
 def get_tableau_data(patient_id):
     try:
-        data = get_patient_data(patient_id)
+        as_of = resolve_as_of(request.args.get('as_of'))
+    except ValueError:
+        return jsonify({'error': 'as_of must be a date in YYYY-MM-DD format'}), 400
+
+    try:
+        data = get_patient_data(patient_id, as_of)
         tableau_data = flatten_for_tableau(data)
-        return jsonify(tableau_data)
+        # Results only depend on (patient_id, as_of): the browser may reuse them for five
+        # minutes and then revalidate by ETag. Private, so shared caches do not store them.
+        # A failed query raises before this point, so errors never get these headers
+        response = jsonify(tableau_data)
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.max_age = 300
+        return response.make_conditional(request)
     except Exception as e:
         print(f"Error: {e}")
         import traceback
@@ -484,8 +659,131 @@ def get_tableau_data(patient_id):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/tableau/patient/<int:patient_id>/summary')
+def get_tableau_summary(patient_id):
+    """
+    Patient-level fields shared by every row (`base`) and the summary rows; the WDC
+    pages through the detail sections separately and merges `base` into each row
+    """
+    try:
+        as_of = resolve_as_of(request.args.get('as_of'))
+    except ValueError:
+        return jsonify({'error': 'as_of must be a date in YYYY-MM-DD format'}), 400
+
+    try:
+        data = get_patient_summary(patient_id, as_of)
+        base = tableau_base(data)
+        return jsonify({
+            'as_of': data['as_of'],
+            'base': base,
+            'rows': summary_rows(base, data)
+        })
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/tableau/patient/<int:patient_id>/<section>')
+def get_tableau_page(patient_id, section):
+    """Keyset-paginated detail rows: ?limit=<n>&cursor=<next_cursor of the previous page>"""
+    if section not in DETAIL_PAGES:
+        return jsonify({'error': f"Unknown section '{section}'"}), 404
+
+    try:
+        as_of = resolve_as_of(request.args.get('as_of'))
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer and as_of a date in YYYY-MM-DD format'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        rows, next_cursor = get_detail_page(patient_id, section, request.args.get('cursor'), limit, as_of)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    build_row = PAGE_ROW_BUILDERS[section]
+    base = {'patient_id': patient_id}
+    return jsonify({
+        'rows': [build_row(base, row) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+
+# One store per process: under gunicorn each worker loads its own copy and refreshes
+# it on use once it is older than FEATURE_MAX_AGE seconds. Loads read the whole
+# population, so they use connections of their own, outside the pool and uncapped.
+FEATURE_STORE = FeatureStore(get_direct_connection)
+FEATURE_MAX_AGE = 300
+
+
+@app.route('/api/risk/rescore', methods=['POST'])
+def rescore_population():
+    """
+    Score the whole population with what-if weights/thresholds, e.g.
+    {"weights": {"opioid_dx": 40}, "thresholds": {"frequent_ed": 2}, "levels": {"HIGH": 35}}
+    and compare with the current model
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        changed_limit = int(body.pop('changed_limit', 1000))
+        model = merge_model(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        FEATURE_STORE.ensure_fresh(FEATURE_MAX_AGE)
+        return jsonify(FEATURE_STORE.rescore(model, changed_limit))
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/risk/features/refresh', methods=['POST'])
+def refresh_features():
+    """
+    Incremental refresh of the feature matrix (?full=1 for a full reload). Only
+    refreshes the worker that serves the request; the others catch up within
+    FEATURE_MAX_AGE seconds
+    """
+    try:
+        started = datetime.now()
+        if request.args.get('full') in ('1', 'true'):
+            updated = FEATURE_STORE.load()
+        else:
+            updated = FEATURE_STORE.refresh()
+        return jsonify({
+            'patients': int(len(FEATURE_STORE.patient_ids)),
+            'updated_patients': updated,
+            'as_of': FEATURE_STORE.as_of.isoformat(),
+            'worker_pid': os.getpid(),
+            'elapsed_ms': round((datetime.now() - started).total_seconds() * 1000, 1)
+        })
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/profile/summary')
+def profile_summary():
+    """Cached summary of the last bulk data-quality report (see profiler.py)"""
+    summary = profiler.load_summary()
+    if summary is None:
+        return jsonify({'error': 'No data-quality report yet, run `python profiler.py`'}), 404
+    return jsonify(summary)
+
+
+@app.route('/api/stats/statements')
+def statement_stats():
+    """Prepare/execute counters and timings of the registered statements"""
+    return jsonify(STATEMENTS.stats())
+
+
 @app.route('/api/test/connection')
 def test_connection():
+    conn = cursor = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
@@ -496,9 +794,6 @@ def test_connection():
         cursor.execute("SELECT DISTINCT patient_id FROM hf_encounter LIMIT 10")
         patients = cursor.fetchall()
         
-        cursor.close()
-        conn.close()
-        
         return jsonify({
             'status': 'SUCCESS',
             'encounter_count': encounter_count['count'],
@@ -506,6 +801,11 @@ def test_connection():
         })
     except Exception as e:
         return jsonify({'status': 'FAILED', 'error': str(e)}), 500
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
 
 
 if __name__ == '__main__':
@@ -1,45 +1,19 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, jsonify, render_template, request
 from flask_cors import CORS
 
+import threading
+import time
 
-import mysql.connector
 from mysql.connector import Error
 
-from sshtunnel import SSHTunnelForwarder
-
-# Local config (must exist)
-from config.constants import (
-    SSH_HOST,
-    SSH_PORT,
-    SSH_USER,
-    SSH_PASS,
-    DB_USER,
-    DB_PASS,
-    DB_NAME,
-)
+import mme_timeline
+from db import get_db_connection, resolve_as_of, STATEMENTS
+from health import health
 
 
 app = Flask(__name__)
 CORS(app)
-
-
-def get_db_connection():
-    server = SSHTunnelForwarder(
-        ssh_address_or_host=(SSH_HOST,SSH_PORT ), 
-        ssh_username=SSH_USER,                   
-        ssh_password=SSH_PASS,                
-        remote_bind_address=('localhost', 3306)     
-    )
-
-    server.start()    
-    conn=  mysql.connector.connect(
-        host='localhost',              
-        port=server.local_bind_port,   
-        user=DB_USER,                
-        password=DB_PASS,        
-        database= DB_NAME        
-    )
-    return conn
+app.register_blueprint(health)
 
 
 @app.route('/')
@@ -103,12 +77,116 @@ def calculate_daily_mme(strength, frequency_desc, generic_name):
     return round(daily_mme, 2)
 
 
-@app.route('/tableau-data/<int:patient_id>')
-def get_tableau_data(patient_id):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    query = """
+# t_MME.medication_row_id is added by the first mme_backfill.py run. Until it exists
+# the queries leave out the stored scores and every score is computed per request.
+STORED_MME_COLUMN = 'mme.mme_score as stored_mme'
+STORED_MME_JOIN = 'LEFT JOIN t_MME mme ON m.medication_row_id = mme.medication_row_id'
+STORED_MME_RECHECK_SECONDS = 300
+
+_stored_mme_lock = threading.Lock()
+_stored_mme = {'available': False, 'checked_at': None}
+
+
+def stored_mme_available():
+    """Whether t_MME has per-medication scores; a missing column is re-checked every few minutes"""
+    with _stored_mme_lock:
+        checked_at = _stored_mme['checked_at']
+        if _stored_mme['available'] or (
+                checked_at is not None and time.monotonic() - checked_at < STORED_MME_RECHECK_SECONDS):
+            return _stored_mme['available']
+
+        conn = cursor = None
+        try:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 't_MME' AND COLUMN_NAME = 'medication_row_id'
+            """)
+            available = cursor.fetchone()[0] > 0
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if conn is not None:
+                conn.close()
+        _stored_mme.update(available=available, checked_at=time.monotonic())
+        return available
+
+
+def stored_mme_sql():
+    """(column, join) to splice into a medication query"""
+    if stored_mme_available():
+        return STORED_MME_COLUMN, STORED_MME_JOIN
+    return 'NULL as stored_mme', ''
+
+
+def resolve_daily_mme(row):
+    # Scores are precomputed by mme_backfill.py; only medications added since the
+    # last run are scored at request time
+    if row.get('stored_mme') is not None:
+        return float(row['stored_mme'])
+    return calculate_daily_mme(
+        row['order_strength'],
+        row['frequency_desc'],
+        row['generic_name']
+    )
+
+
+MME_TIMELINE_QUERY = """
+    SELECT
+        e.patient_id,
+        m.medication_row_id,
+        m.generic_name,
+        m.order_strength,
+        m.frequency_desc,
+        m.med_started_dt_tm,
+        m.med_stopped_dt_tm,
+        {stored_mme}
+    FROM hf_encounter e
+    INNER JOIN hf_medication m ON e.encounter_id = m.encounter_id
+    {stored_mme_join}
+    WHERE e.patient_id IN ({placeholders})
+    AND m.generic_name IS NOT NULL
+    AND m.generic_name REGEXP 'TRAMADOL|CODEINE|HYDROCODONE|OXYCODONE|MORPHINE|FENTANYL|HYDROMORPHONE|METHADONE'
+    """
+
+MAX_BULK_PATIENTS = 1000
+
+
+def get_mme_timeline(patient_ids, as_of=None, daily=False, summary_only=False):
+    """Concurrent MME timeline rows (or per-patient summaries) for the given patients"""
+    stored_mme, stored_mme_join = stored_mme_sql()
+    conn = cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        query = MME_TIMELINE_QUERY.format(placeholders=', '.join(['%s'] * len(patient_ids)),
+                                          stored_mme=stored_mme, stored_mme_join=stored_mme_join)
+        cursor.execute(query, tuple(patient_ids))
+        rows = cursor.fetchall()
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
+
+    for row in rows:
+        row['daily_mme'] = resolve_daily_mme(row)
+
+    timeline = mme_timeline.build_timeline(*mme_timeline.intervals_from_rows(rows, as_of))
+    summary = mme_timeline.summarize_timeline(timeline)
+    if summary_only:
+        return [dict(patient_id=patient_id, **values) for patient_id, values in summary.items()]
+    return mme_timeline.timeline_rows(timeline, summary, daily=daily)
+
+
+def _timeline_args():
+    as_of = resolve_as_of(request.args.get('as_of') or None)
+    daily = request.args.get('granularity', 'change') == 'day'
+    return as_of, daily
+
+
+TABLEAU_DATA_QUERY = """
     SELECT
         p.patient_id,
         p.race,
@@ -124,7 +202,7 @@ def get_tableau_data(patient_id):
         m.frequency_desc,
         m.med_started_dt_tm,
         m.med_stopped_dt_tm,
-        mme.mme_score as stored_mme,
+        {stored_mme},
         p_od.label as od_risk_flag,
         p_oud.label as oud_risk_flag,
         d.diagnosis_code,
@@ -136,7 +214,7 @@ def get_tableau_data(patient_id):
     FROM t_patient p
     INNER JOIN hf_encounter e ON p.patient_id = e.patient_id
     INNER JOIN hf_medication m ON e.encounter_id = m.encounter_id
-    LEFT JOIN t_MME mme ON e.encounter_id = mme.encounter_id
+    {stored_mme_join}
     LEFT JOIN t_prediction_od p_od ON e.patient_id = p_od.patient_id
     LEFT JOIN t_prediction_oud p_oud ON e.patient_id = p_oud.patient_id
     LEFT JOIN hf_diagnosis d ON e.encounter_id = d.encounter_id AND d.diagnosis_priority = 1
@@ -145,10 +223,18 @@ def get_tableau_data(patient_id):
     AND m.generic_name REGEXP 'TRAMADOL|CODEINE|HYDROCODONE|OXYCODONE|MORPHINE|FENTANYL|HYDROMORPHONE|METHADONE'
     ORDER BY m.med_started_dt_tm
     """
-    
+
+STATEMENTS.register('dashboard2.tableau_data', TABLEAU_DATA_QUERY.format(
+    stored_mme=STORED_MME_COLUMN, stored_mme_join=STORED_MME_JOIN))
+STATEMENTS.register('dashboard2.tableau_data_computed', TABLEAU_DATA_QUERY.format(
+    stored_mme='NULL as stored_mme', stored_mme_join=''))
+
+
+@app.route('/tableau-data/<int:patient_id>')
+def get_tableau_data(patient_id):
     try:
-        cursor.execute(query, (patient_id,))
-        data = cursor.fetchall()
+        statement = 'dashboard2.tableau_data' if stored_mme_available() else 'dashboard2.tableau_data_computed'
+        data = STATEMENTS.execute(statement, (patient_id,))
         
         if not data:
             return jsonify({
@@ -156,15 +242,7 @@ def get_tableau_data(patient_id):
             }), 404
         
         for row in data:
-            if row.get('stored_mme') and row['stored_mme'] > 0:
-                daily_mme = float(row['stored_mme'])
-            else:
-                daily_mme = calculate_daily_mme(
-                    row['order_strength'],
-                    row['frequency_desc'],
-                    row['generic_name']
-                )
-            
+            daily_mme = resolve_daily_mme(row)
             row['daily_mme'] = daily_mme
             
             if daily_mme >= 90:
@@ -236,21 +314,60 @@ def get_tableau_data(patient_id):
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
+
+
+@app.route('/tableau-data/<int:patient_id>/mme-timeline')
+def get_patient_mme_timeline(patient_id):
+    """
+    Total concurrent MME per change point (or per day with ?granularity=day),
+    with peak MME and days at/above 50 and 90 MME as summary columns
+    """
+    try:
+        as_of, daily = _timeline_args()
+    except ValueError:
+        return jsonify({"error": "as_of must be a date in YYYY-MM-DD format"}), 400
+
+    try:
+        rows = get_mme_timeline([patient_id], as_of, daily)
+        if not rows:
+            return jsonify({
+                "error": f"No opioid prescription data found for patient {patient_id}"
+            }), 404
+        return jsonify(rows)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/tableau-data/mme-timeline')
+def get_bulk_mme_timeline():
+    """Bulk mode: ?patient_ids=1,2,3 (add &summary=1 for one summary row per patient)"""
+    try:
+        as_of, daily = _timeline_args()
+        patient_ids = [int(p) for p in request.args.get('patient_ids', '').split(',') if p.strip()]
+    except ValueError:
+        return jsonify({"error": "patient_ids must be comma-separated integers and as_of YYYY-MM-DD"}), 400
+
+    if not patient_ids:
+        return jsonify({"error": "patient_ids is required"}), 400
+    if len(patient_ids) > MAX_BULK_PATIENTS:
+        return jsonify({"error": f"At most {MAX_BULK_PATIENTS} patients per request"}), 400
+
+    try:
+        summary_only = request.args.get('summary') in ('1', 'true')
+        return jsonify(get_mme_timeline(patient_ids, as_of, daily, summary_only))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 
 @app.route('/test')
 def test_connection():
     """Test database connection"""
+    conn = cursor = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
         cursor.execute("SELECT COUNT(*) as count FROM t_patient")
         result = cursor.fetchone()
-        cursor.close()
-        conn.close()
         
         return jsonify({
             'status': 'success',
@@ -262,6 +379,11 @@ def test_connection():
             'status': 'error',
             'message': str(e)
         }), 500
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
 
 
 if __name__ == '__main__': 
@@ -4,44 +4,15 @@ from flask_cors import CORS
 from datetime import datetime
 from decimal import Decimal
 
-import mysql.connector
 from mysql.connector import Error
 
-from sshtunnel import SSHTunnelForwarder
-
-# Local config (must exist)
-from config.constants import (
-    SSH_HOST,
-    SSH_PORT,
-    SSH_USER,
-    SSH_PASS,
-    DB_USER,
-    DB_PASS,
-    DB_NAME,
-)
+from db import get_db_connection
+from health import health
 
 
 app = Flask(__name__)
 CORS(app)
-
-
-def get_db_connection():
-    server = SSHTunnelForwarder(
-        ssh_address_or_host=(SSH_HOST,SSH_PORT ), 
-        ssh_username=SSH_USER,                   
-        ssh_password=SSH_PASS,                
-        remote_bind_address=('localhost', 3306)     
-    )
-
-    server.start()    
-    conn=  mysql.connector.connect(
-        host='localhost',              
-        port=server.local_bind_port,   
-        user=DB_USER,                
-        password=DB_PASS,        
-        database= DB_NAME        
-    )
-    return conn
+app.register_blueprint(health)
 
 
 @app.route("/")
@@ -51,8 +22,7 @@ def home():
 
 @app.route("/api/tableau-opioid-data")
 def tableau_data():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    conn = cursor = None
 
     query = """
         SELECT 
@@ -89,6 +59,8 @@ def tableau_data():
     """
 
     try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
         cursor.execute(query)
         rows = cursor.fetchall()
         
@@ -100,11 +72,13 @@ def tableau_data():
         return jsonify(rows)
 
     except Exception as e:
-        return jsonify({"error": str(e)})
+        return jsonify({"error": str(e)}), 500
     
     finally:
-        cursor.close()
-        conn.close()
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
 
 if __name__ == '__main__': 
     app.run(debug=True, host='0.0.0.0', port=5000)
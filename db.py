@@ -0,0 +1,371 @@
+"""
+Shared database access for the dashboards.
+
+One SSH tunnel and one MySQL connection pool per process, created on first use,
+plus a registry of named, parameterized statements. Registered statements are
+prepared once per pooled connection (server-side prepared statements, results
+fetched over the binary protocol) and afterwards only executed by name with new
+parameters.
+"""
+import os
+import re
+import threading
+import time
+import weakref
+from collections import defaultdict
+from datetime import date, datetime
+
+import mysql.connector
+from mysql.connector import Error, FieldType, pooling
+from mysql.connector.constants import DEFAULT_CONFIGURATION
+from sshtunnel import SSHTunnelForwarder
+
+from config import constants
+from config.constants import (
+    SSH_HOST,
+    SSH_PORT,
+    SSH_USER,
+    SSH_PASS,
+    DB_USER,
+    DB_PASS,
+    DB_NAME,
+)
+
+
+# Optional tuning, may be overridden in config/constants.py
+POOL_NAME = getattr(constants, 'DB_POOL_NAME', 'dashboard')
+POOL_SIZE = getattr(constants, 'DB_POOL_SIZE', 5)
+POOL_TIMEOUT = getattr(constants, 'DB_POOL_TIMEOUT', 10)
+FETCH_BATCH_SIZE = getattr(constants, 'DB_FETCH_BATCH_SIZE', 1000)
+# Upper bound in seconds for a registered statement (a MAX_EXECUTION_TIME optimizer
+# hint). Off by default; the served workers turn it on after fork. Population-wide
+# reads (feature store, information_schema, dashboard3) are not registered statements
+# and are never capped.
+QUERY_TIMEOUT = None
+
+_lock = threading.RLock()
+_state = {'tunnel': None, 'pool': None, 'pid': os.getpid()}
+
+
+def reset_after_fork(min_pool_size=None, query_timeout=None):
+    """
+    Forget the tunnel, pool and prepared cursors inherited from a parent process
+    so a forked worker opens its own. Called by the pre-fork server after forking;
+    get_tunnel() also does it when it notices a new process id.
+    """
+    global _lock, POOL_SIZE, QUERY_TIMEOUT
+    _lock = threading.RLock()
+    _state.update(tunnel=None, pool=None, pid=os.getpid())
+    STATEMENTS.reset_connections()
+    if min_pool_size:
+        POOL_SIZE = max(POOL_SIZE, min_pool_size)
+    if query_timeout:
+        QUERY_TIMEOUT = query_timeout
+
+
+def get_tunnel():
+    if _state['pid'] != os.getpid():
+        reset_after_fork()
+    with _lock:
+        tunnel = _state['tunnel']
+        if tunnel is None or not tunnel.is_active:
+            if tunnel is not None:
+                tunnel.stop()
+            tunnel = SSHTunnelForwarder(
+                ssh_address_or_host=(SSH_HOST, SSH_PORT),
+                ssh_username=SSH_USER,
+                ssh_password=SSH_PASS,
+                remote_bind_address=('localhost', 3306)
+            )
+            tunnel.start()
+            _state['tunnel'] = tunnel
+            # Connections of an old pool point at the old local port
+            _state['pool'] = None
+        return tunnel
+
+
+def get_pool():
+    with _lock:
+        tunnel = get_tunnel()
+        if _state['pool'] is None:
+            _state['pool'] = pooling.MySQLConnectionPool(
+                pool_name=POOL_NAME,
+                pool_size=POOL_SIZE,
+                # Resetting the session would drop the prepared statements of the connection
+                pool_reset_session=False,
+                autocommit=True,
+                host='localhost',
+                port=tunnel.local_bind_port,
+                user=DB_USER,
+                password=DB_PASS,
+                database=DB_NAME
+            )
+        return _state['pool']
+
+
+def get_direct_connection(timeout=None):
+    """
+    A connection of its own through the tunnel, outside the pool (close() really
+    closes it). With `timeout`, connecting and every read give up after that many
+    seconds instead of waiting on a hung server.
+    """
+    tunnel = get_tunnel()
+    options = {}
+    if timeout:
+        options['connection_timeout'] = timeout
+        # Newer drivers only apply connection_timeout to the handshake and bound reads separately
+        if 'read_timeout' in DEFAULT_CONFIGURATION:
+            options['read_timeout'] = timeout
+    return mysql.connector.connect(
+        host='localhost',
+        port=tunnel.local_bind_port,
+        user=DB_USER,
+        password=DB_PASS,
+        database=DB_NAME,
+        **options
+    )
+
+
+def tunnel_status():
+    """State of the tunnel and pool, without opening anything"""
+    tunnel = _state['tunnel']
+    pool = _state['pool']
+    status = {
+        'tunnel': 'not_started' if tunnel is None else ('active' if tunnel.is_active else 'down'),
+        'pool': 'not_started' if pool is None else 'ready',
+    }
+    if pool is not None:
+        status['pool_size'] = pool.pool_size
+        queue = getattr(pool, '_cnx_queue', None)
+        if queue is not None:
+            status['pool_idle'] = queue.qsize()
+    return status
+
+
+def get_db_connection(timeout=POOL_TIMEOUT):
+    """Borrow a pooled connection; close() returns it to the pool"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return get_pool().get_connection()
+        except pooling.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def resolve_as_of(as_of=None):
+    """Evaluation date for the time-window metrics, truncated to the day (defaults to today)"""
+    if as_of is None:
+        return date.today()
+    if isinstance(as_of, datetime):
+        return as_of.date()
+    if isinstance(as_of, date):
+        return as_of
+    return datetime.strptime(str(as_of), '%Y-%m-%d').date()
+
+
+# Unknown prepared statement handler, server gone away, lost connection, not
+# connected: the prepared cursor is stale and is worth preparing again once
+RETRYABLE_ERRORS = (1243, 2006, 2013, 2055)
+
+# Per-column converters to JSON-ready values, picked once from the column's MySQL type
+COLUMN_CONVERTERS = {
+    FieldType.DECIMAL: float,
+    FieldType.NEWDECIMAL: float,
+    FieldType.DATETIME: lambda value: value.isoformat(),
+    FieldType.TIMESTAMP: lambda value: value.isoformat(),
+}
+
+
+class RowView:
+    """Read-only dict-like view of one row of a ColumnResult; allocates no per-row dict"""
+    __slots__ = ('_result', '_index')
+
+    def __init__(self, result, index):
+        self._result = result
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._result.data[self._result.positions[key]][self._index]
+
+    def get(self, key, default=None):
+        position = self._result.positions.get(key)
+        if position is None:
+            return default
+        return self._result.data[position][self._index]
+
+    def keys(self):
+        return list(self._result.columns)
+
+    def to_dict(self):
+        return {column: values[self._index] for column, values in zip(self._result.columns, self._result.data)}
+
+
+class ColumnResult:
+    """Query result stored column by column: names, one list per column, and row views on demand"""
+    __slots__ = ('columns', 'data', 'positions')
+
+    def __init__(self, columns=(), data=None):
+        self.columns = tuple(columns)
+        self.data = data if data is not None else [[] for _ in self.columns]
+        self.positions = {column: i for i, column in enumerate(self.columns)}
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ColumnResult(self.columns, [values[index] for values in self.data])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return RowView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield RowView(self, index)
+
+    def column(self, name):
+        return self.data[self.positions[name]]
+
+    def to_records(self):
+        return [dict(zip(self.columns, row)) for row in zip(*self.data)]
+
+
+def fetch_columns(cursor, batch_size=FETCH_BATCH_SIZE):
+    """Drain `cursor` with fetchmany() into a ColumnResult of converted, JSON-ready values"""
+    result = ColumnResult(cursor.column_names)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for values, batch_values in zip(result.data, zip(*batch)):
+            values.extend(batch_values)
+
+    for position, description in enumerate(cursor.description or ()):
+        convert = COLUMN_CONVERTERS.get(description[1])
+        if convert is not None:
+            result.data[position] = [None if v is None else convert(v) for v in result.data[position]]
+    return result
+
+
+class StatementRegistry:
+    """Named, parameterized statements prepared once per connection, with timing counters"""
+
+    def __init__(self):
+        self._statements = {}
+        # underlying connection -> {statement name: prepared cursor}
+        self._cursors = weakref.WeakKeyDictionary()
+        self._stats = defaultdict(lambda: {
+            'calls': 0, 'prepares': 0, 'errors': 0, 'rows': 0, 'total_ms': 0.0, 'max_ms': 0.0
+        })
+        self._lock = threading.Lock()
+
+    def register(self, name, sql):
+        if name in self._statements and self._statements[name] != sql:
+            raise ValueError(f"Statement {name!r} is already registered with different SQL")
+        self._statements[name] = sql
+        return name
+
+    def sql(self, name):
+        """SQL of a registered statement, with the QUERY_TIMEOUT hint when it is set"""
+        sql = self._statements[name]
+        if QUERY_TIMEOUT:
+            sql = re.sub(r'^\s*SELECT\b', 'SELECT /*+ MAX_EXECUTION_TIME({}) */'.format(int(QUERY_TIMEOUT * 1000)),
+                         sql, count=1, flags=re.IGNORECASE)
+        return sql
+
+    def _cursor(self, conn, name):
+        raw = getattr(conn, '_cnx', conn)
+        with self._lock:
+            cursors = self._cursors.setdefault(raw, {})
+            cursor = cursors.get(name)
+            if cursor is None:
+                cursor = cursors[name] = raw.cursor(prepared=True)
+                self._stats[name]['prepares'] += 1
+        return cursor
+
+    def _forget(self, conn, name):
+        raw = getattr(conn, '_cnx', conn)
+        with self._lock:
+            cursor = self._cursors.get(raw, {}).pop(name, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Error:
+                pass
+
+    def execute(self, name, params=(), conn=None):
+        """Execute a registered statement and return its rows as dicts"""
+        return self._run(name, params, conn, self._fetch_dicts)
+
+    def execute_columns(self, name, params=(), conn=None, batch_size=FETCH_BATCH_SIZE):
+        """Execute a registered statement and return a ColumnResult with JSON-ready values"""
+        return self._run(name, params, conn, lambda cursor: fetch_columns(cursor, batch_size))
+
+    @staticmethod
+    def _fetch_dicts(cursor):
+        columns = cursor.column_names
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _run(self, name, params, conn, fetch):
+        sql = self.sql(name)
+        own_conn = conn is None
+        if own_conn:
+            conn = get_db_connection()
+
+        started = time.perf_counter()
+        try:
+            try:
+                cursor = self._cursor(conn, name)
+                cursor.execute(sql, params)
+            except Error as e:
+                # The connection may have been re-established, which invalidates its
+                # prepared statements: prepare again once. Anything else (SQL errors,
+                # a statement killed by its time limit) is not retried.
+                if e.errno not in RETRYABLE_ERRORS:
+                    raise
+                self._forget(conn, name)
+                cursor = self._cursor(conn, name)
+                cursor.execute(sql, params)
+            rows = fetch(cursor)
+        except Exception:
+            with self._lock:
+                self._stats[name]['errors'] += 1
+            raise
+        finally:
+            if own_conn:
+                conn.close()
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats[name]
+            stats['calls'] += 1
+            stats['rows'] += len(rows)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name in self._statements:
+                stats = dict(self._stats[name])
+                stats['avg_ms'] = round(stats['total_ms'] / stats['calls'], 3) if stats['calls'] else 0.0
+                stats['total_ms'] = round(stats['total_ms'], 3)
+                stats['max_ms'] = round(stats['max_ms'], 3)
+                result[name] = stats
+            return result
+
+    def reset_connections(self):
+        with self._lock:
+            self._cursors = weakref.WeakKeyDictionary()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+
+STATEMENTS = StatementRegistry()
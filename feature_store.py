@@ -0,0 +1,367 @@
+"""
+In-memory risk feature matrix for the whole population.
+
+Loads the inputs of calculate_risk() (total_rx, rx_last_30_days, opioid_dx,
+substance_dx, ed_visits) for every patient into NumPy arrays with three grouped
+queries, refreshes them incrementally, and scores everyone at once with weights
+and thresholds that can be changed per call.
+"""
+import threading
+import time
+from datetime import date
+
+import numpy as np
+
+
+FEATURES = ('total_rx', 'rx_last_30_days', 'opioid_dx', 'substance_dx', 'ed_visits')
+
+LEVELS = ('LOW', 'MODERATE', 'HIGH', 'CRITICAL')
+
+# The model calculate_risk() uses; a rule adds its weight when its feature >= threshold.
+# 'moderate_rx' only counts when 'high_rx' does not apply.
+DEFAULT_RISK_MODEL = {
+    'weights': {
+        'high_rx': 20,
+        'moderate_rx': 10,
+        'recent_rx': 15,
+        'opioid_dx': 30,
+        'substance_dx': 15,
+        'frequent_ed': 10,
+    },
+    'thresholds': {
+        'high_rx': 10,
+        'moderate_rx': 5,
+        'recent_rx': 2,
+        'opioid_dx': 1,
+        'substance_dx': 1,
+        'frequent_ed': 3,
+    },
+    'levels': {
+        'MODERATE': 20,
+        'HIGH': 40,
+        'CRITICAL': 60,
+    },
+}
+
+RULE_FEATURES = {
+    'high_rx': 'total_rx',
+    'moderate_rx': 'total_rx',
+    'recent_rx': 'rx_last_30_days',
+    'opioid_dx': 'opioid_dx',
+    'substance_dx': 'substance_dx',
+    'frequent_ed': 'ed_visits',
+}
+
+# Patients are re-aggregated in chunks of this many ids during incremental refreshes
+REFRESH_CHUNK = 1000
+
+OPIOID_FILTER = """
+        (LOWER(COALESCE(m.generic_name, '')) LIKE '%oxycodone%'
+         OR LOWER(COALESCE(m.generic_name, '')) LIKE '%hydrocodone%'
+         OR LOWER(COALESCE(m.generic_name, '')) LIKE '%morphine%'
+         OR LOWER(COALESCE(m.generic_name, '')) LIKE '%fentanyl%'
+         OR LOWER(COALESCE(m.generic_name, '')) LIKE '%codeine%'
+         OR LOWER(COALESCE(m.generic_name, '')) LIKE '%tramadol%')"""
+
+ENCOUNTER_FEATURES_QUERY = """
+    SELECT
+        e.patient_id,
+        COALESCE(SUM(CASE WHEN LOWER(COALESCE(e.patient_type_desc, '')) LIKE '%emergency%' THEN 1 ELSE 0 END), 0) as ed_visits
+    FROM hf_encounter e
+    WHERE 1 = 1 {patients}
+    GROUP BY e.patient_id
+"""
+
+MEDICATION_FEATURES_QUERY = """
+    SELECT
+        e.patient_id,
+        COUNT(DISTINCT m.medication_row_id) as total_rx,
+        COALESCE(SUM(CASE WHEN m.med_started_dt_tm >= DATE_SUB(%s, INTERVAL 30 DAY) THEN 1 ELSE 0 END), 0) as rx_last_30_days
+    FROM hf_medication m
+    JOIN hf_encounter e ON m.encounter_id = e.encounter_id
+    WHERE """ + OPIOID_FILTER + """ {patients}
+    GROUP BY e.patient_id
+"""
+
+DIAGNOSIS_FEATURES_QUERY = """
+    SELECT
+        e.patient_id,
+        COALESCE(SUM(CASE WHEN d.diagnosis_icd LIKE 'F11%' OR d.diagnosis_icd LIKE 'T40%' THEN 1 ELSE 0 END), 0) as opioid_dx,
+        COALESCE(SUM(CASE WHEN d.diagnosis_icd LIKE 'F1%' THEN 1 ELSE 0 END), 0) as substance_dx
+    FROM hf_diagnosis d
+    JOIN hf_encounter e ON d.encounter_id = e.encounter_id
+    WHERE 1 = 1 {patients}
+    GROUP BY e.patient_id
+"""
+
+WATERMARK_QUERY = """
+    SELECT
+        (SELECT COALESCE(MAX(encounter_id), 0) FROM hf_encounter) as encounter_id,
+        (SELECT COALESCE(MAX(medication_row_id), 0) FROM hf_medication) as medication_row_id,
+        (SELECT COALESCE(MAX(diagnosis_row_id), 0) FROM hf_diagnosis) as diagnosis_row_id
+"""
+
+CHANGED_PATIENTS_QUERY = """
+    SELECT e.patient_id FROM hf_encounter e WHERE e.encounter_id > %s
+    UNION
+    SELECT e.patient_id FROM hf_medication m JOIN hf_encounter e ON m.encounter_id = e.encounter_id
+    WHERE m.medication_row_id > %s
+    UNION
+    SELECT e.patient_id FROM hf_diagnosis d JOIN hf_encounter e ON d.encounter_id = e.encounter_id
+    WHERE d.diagnosis_row_id > %s
+"""
+
+
+def merge_model(overrides=None):
+    """DEFAULT_RISK_MODEL with the given weights/thresholds/levels replaced; ValueError on unknown keys"""
+    model = {section: dict(values) for section, values in DEFAULT_RISK_MODEL.items()}
+    for section, values in (overrides or {}).items():
+        if section not in model:
+            raise ValueError(f"Unknown model section '{section}'")
+        if not isinstance(values, dict):
+            raise ValueError(f"'{section}' must be an object")
+        for key, value in values.items():
+            if key not in model[section]:
+                raise ValueError(f"Unknown {section} key '{key}'")
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{section}.{key} must be a number")
+            model[section][key] = value
+    return model
+
+
+def risk_level(score, model=DEFAULT_RISK_MODEL):
+    levels = model['levels']
+    if score >= levels['CRITICAL']:
+        return 'CRITICAL'
+    if score >= levels['HIGH']:
+        return 'HIGH'
+    if score >= levels['MODERATE']:
+        return 'MODERATE'
+    return 'LOW'
+
+
+def score_matrix(features, model=DEFAULT_RISK_MODEL):
+    """Vectorized calculate_risk(): (scores capped at 100, level codes indexing LEVELS)"""
+    weights = model['weights']
+    thresholds = model['thresholds']
+
+    def hit(rule):
+        return features[RULE_FEATURES[rule]] >= thresholds[rule]
+
+    high_rx = hit('high_rx')
+    score = np.where(high_rx, weights['high_rx'], 0).astype(np.float64)
+    score += np.where(~high_rx & hit('moderate_rx'), weights['moderate_rx'], 0)
+    for rule in ('recent_rx', 'opioid_dx', 'substance_dx', 'frequent_ed'):
+        score += np.where(hit(rule), weights[rule], 0)
+
+    levels = model['levels']
+    level_codes = np.select(
+        [score >= levels['CRITICAL'], score >= levels['HIGH'], score >= levels['MODERATE']],
+        [3, 2, 1],
+        default=0
+    ).astype(np.int8)
+    return np.minimum(score, 100), level_codes
+
+
+class FeatureStore:
+    """
+    Per-patient risk features for the population, held as aligned NumPy arrays sorted
+    by patient_id. The store lives in the memory of one process: every pre-fork
+    worker has its own copy and keeps it fresh with ensure_fresh().
+
+    `get_connection` should hand out connections without a query time limit and
+    outside the request pool: the loads are population-wide GROUP BY queries.
+    """
+
+    def __init__(self, get_connection):
+        self._get_connection = get_connection
+        # _lock guards swapping the arrays; _refresh_lock lets one load/refresh run at a time
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._background = None
+        self.patient_ids = np.empty(0, dtype=np.int64)
+        self.features = {name: np.empty(0, dtype=np.int32) for name in FEATURES}
+        self.as_of = None
+        self.loaded_at = None
+        self.watermarks = None
+
+    def _fetch(self, conn, query, params=()):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, params or None)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _aggregate(self, conn, as_of, patient_ids=None):
+        """Feature arrays for all patients, or only for the given ones"""
+        patients, params = '', ()
+        if patient_ids is not None:
+            patients = 'AND e.patient_id IN ({})'.format(', '.join(['%s'] * len(patient_ids)))
+            params = tuple(patient_ids)
+
+        encounters = self._fetch(conn, ENCOUNTER_FEATURES_QUERY.format(patients=patients), params)
+        ids = np.array(sorted(row[0] for row in encounters), dtype=np.int64)
+        features = {name: np.zeros(len(ids), dtype=np.int32) for name in FEATURES}
+
+        def scatter(rows, names):
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            index = np.searchsorted(ids, np.array(columns[0], dtype=np.int64))
+            for offset, name in enumerate(names, start=1):
+                features[name][index] = np.array([int(v or 0) for v in columns[offset]], dtype=np.int32)
+
+        scatter(encounters, ('ed_visits',))
+        scatter(self._fetch(conn, MEDICATION_FEATURES_QUERY.format(patients=patients), (as_of,) + params),
+                ('total_rx', 'rx_last_30_days'))
+        scatter(self._fetch(conn, DIAGNOSIS_FEATURES_QUERY.format(patients=patients), params),
+                ('opioid_dx', 'substance_dx'))
+        return ids, features
+
+    def load(self, as_of=None):
+        """Full reload of every patient's features"""
+        with self._refresh_lock:
+            return self._load(as_of or date.today())
+
+    def _load(self, as_of):
+        conn = self._get_connection()
+        try:
+            watermarks = self._fetch(conn, WATERMARK_QUERY)[0]
+            ids, features = self._aggregate(conn, as_of)
+        finally:
+            conn.close()
+
+        with self._lock:
+            self.patient_ids, self.features = ids, features
+            self.as_of, self.watermarks, self.loaded_at = as_of, watermarks, time.time()
+        return len(ids)
+
+    def refresh(self, as_of=None):
+        """
+        Re-aggregate only patients with rows added since the last load (row ids are
+        assumed to increase). A new as_of day changes rx_last_30_days for everyone,
+        so it triggers a full reload.
+        """
+        with self._refresh_lock:
+            return self._refresh(as_of or date.today())
+
+    def _refresh(self, as_of):
+        if self.watermarks is None or self.as_of != as_of:
+            return self._load(as_of)
+
+        conn = self._get_connection()
+        try:
+            watermarks = self._fetch(conn, WATERMARK_QUERY)[0]
+            changed = [row[0] for row in self._fetch(conn, CHANGED_PATIENTS_QUERY, self.watermarks)]
+            updates = [self._aggregate(conn, as_of, changed[i:i + REFRESH_CHUNK])
+                       for i in range(0, len(changed), REFRESH_CHUNK)]
+        finally:
+            conn.close()
+
+        with self._lock:
+            ids, features = self.patient_ids, self.features
+            for new_ids, new_features in updates:
+                ids, features = self._merge(ids, features, new_ids, new_features)
+            self.patient_ids, self.features = ids, features
+            self.watermarks, self.loaded_at = watermarks, time.time()
+        return len(changed)
+
+    @staticmethod
+    def _merge(ids, features, new_ids, new_features):
+        known = np.isin(new_ids, ids)
+        index = np.searchsorted(ids, new_ids[known])
+        features = {name: values.copy() for name, values in features.items()}
+        for name in FEATURES:
+            features[name][index] = new_features[name][known]
+        if known.all():
+            return ids, features
+
+        merged_ids = np.concatenate([ids, new_ids[~known]])
+        order = np.argsort(merged_ids, kind='stable')
+        merged = {
+            name: np.concatenate([features[name], new_features[name][~known]])[order]
+            for name in FEATURES
+        }
+        return merged_ids[order], merged
+
+    def _staleness(self, max_age, as_of):
+        if self.loaded_at is None or self.as_of != as_of:
+            return 'load'
+        if time.time() - self.loaded_at >= max_age:
+            return 'refresh'
+        return None
+
+    def _update(self, max_age, as_of):
+        with self._refresh_lock:
+            # Another thread may have refreshed while this one waited for the lock
+            action = self._staleness(max_age, as_of)
+            if action == 'load':
+                self._load(as_of)
+            elif action == 'refresh':
+                self._refresh(as_of)
+
+    def _update_in_background(self, max_age, as_of):
+        try:
+            self._update(max_age, as_of)
+        except Exception as e:
+            print(f"Feature refresh failed: {e}")
+
+    def ensure_fresh(self, max_age, as_of=None):
+        """
+        Load the features on first use (blocking: there is nothing to serve yet).
+        Once loaded, a stale store (older than max_age, or of an earlier day) is
+        reloaded or refreshed in a background thread and the current arrays keep
+        being served until it finishes.
+        """
+        as_of = as_of or date.today()
+        if self._staleness(max_age, as_of) is None:
+            return
+        if self.loaded_at is None:
+            self._update(max_age, as_of)
+            return
+        with self._lock:
+            if self._background is not None and self._background.is_alive():
+                return
+            self._background = threading.Thread(target=self._update_in_background,
+                                                args=(max_age, as_of), daemon=True)
+            self._background.start()
+
+    def refreshing(self):
+        background = self._background
+        return background is not None and background.is_alive()
+
+    def snapshot(self):
+        with self._lock:
+            return self.patient_ids, self.features, self.as_of
+
+    def rescore(self, model, changed_limit=1000):
+        """Score everyone with `model` and compare against DEFAULT_RISK_MODEL"""
+        started = time.perf_counter()
+        ids, features, as_of = self.snapshot()
+        baseline_scores, baseline_levels = score_matrix(features, DEFAULT_RISK_MODEL)
+        scores, levels = score_matrix(features, model)
+
+        changed = np.flatnonzero(levels != baseline_levels)
+        return {
+            'as_of': as_of.isoformat() if as_of else None,
+            'refreshing': self.refreshing(),
+            'patients': int(len(ids)),
+            'model': model,
+            'distribution': {level: int(n) for level, n in zip(LEVELS, np.bincount(levels, minlength=4))},
+            'baseline_distribution': {
+                level: int(n) for level, n in zip(LEVELS, np.bincount(baseline_levels, minlength=4))
+            },
+            'changed_count': int(len(changed)),
+            'changed': [
+                {
+                    'patient_id': int(ids[i]),
+                    'from_level': LEVELS[baseline_levels[i]],
+                    'to_level': LEVELS[levels[i]],
+                    'from_score': float(baseline_scores[i]),
+                    'to_score': float(scores[i]),
+                }
+                for i in changed[:changed_limit]
+            ],
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
@@ -0,0 +1,44 @@
+"""
+Gunicorn settings for wsgi.py. Every value can be overridden from the environment.
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+    kill -HUP <master pid>    # graceful reload: new workers import the current code, old ones finish their requests
+"""
+import multiprocessing
+import os
+
+from config import constants
+
+
+bind = os.environ.get('DASHBOARD_BIND', '0.0.0.0:5000')
+
+# Pre-fork workers, each with a pool of threads
+workers = int(os.environ.get('DASHBOARD_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('DASHBOARD_THREADS', 4))
+
+# Bounded queueing: pending connections in the kernel and per worker
+backlog = int(os.environ.get('DASHBOARD_BACKLOG', 256))
+worker_connections = int(os.environ.get('DASHBOARD_WORKER_CONNECTIONS', threads * 4))
+
+# gthread workers report liveness from their main thread, so this only restarts a
+# worker that stopped responding altogether; it does not cut off a slow request
+timeout = int(os.environ.get('DASHBOARD_TIMEOUT', 60))
+# What bounds a slow per-patient request is this limit on each registered statement
+query_timeout = float(os.environ.get('DASHBOARD_QUERY_TIMEOUT', getattr(constants, 'DB_QUERY_TIMEOUT', 30)))
+graceful_timeout = int(os.environ.get('DASHBOARD_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Recycle workers now and then so a slow leak cannot grow forever
+max_requests = int(os.environ.get('DASHBOARD_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+# The apps are imported by each worker (no preload_app), so HUP picks up code changes
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    import db
+    # Each worker gets its own tunnel and pool, with a connection for every thread
+    db.reset_after_fork(min_pool_size=server.cfg.threads, query_timeout=query_timeout)
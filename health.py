@@ -0,0 +1,117 @@
+"""
+Health and statistics endpoints shared by the dashboard apps.
+
+/health/live   process, tunnel and pool state only (no database round trip)
+/health/ready  SELECT 1 on a dedicated connection, bounded by driver timeouts
+/health/stats  approximate row counts from information_schema, cached
+"""
+import threading
+import time
+
+from flask import Blueprint, jsonify
+
+from config import constants
+from db import get_db_connection, get_direct_connection, tunnel_status
+
+
+READY_TIMEOUT = getattr(constants, 'HEALTH_READY_TIMEOUT', 2)
+STATS_CACHE_SECONDS = getattr(constants, 'HEALTH_STATS_CACHE_SECONDS', 300)
+
+health = Blueprint('health', __name__)
+
+_stats_lock = threading.Lock()
+_stats_cache = {'at': 0.0, 'stats': None}
+
+
+def ping(timeout=READY_TIMEOUT):
+    """
+    SELECT 1 on a short-lived connection of its own: the driver times out a hung
+    server, and a slow probe never holds on to one of the pool's connections
+    """
+    conn = get_direct_connection(timeout=timeout)
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+
+def table_stats():
+    conn = cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT TABLE_NAME as table_name,
+                   TABLE_ROWS as approx_rows,
+                   DATA_LENGTH as data_bytes,
+                   INDEX_LENGTH as index_bytes,
+                   UPDATE_TIME as update_time
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE()
+            ORDER BY TABLE_NAME
+        """)
+        rows = cursor.fetchall()
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
+
+    return {
+        row['table_name']: {
+            'approx_rows': int(row['approx_rows'] or 0),
+            'data_bytes': int(row['data_bytes'] or 0),
+            'index_bytes': int(row['index_bytes'] or 0),
+            'update_time': row['update_time'].isoformat() if row['update_time'] else None
+        }
+        for row in rows
+    }
+
+
+@health.route('/health/live')
+def live():
+    status = tunnel_status()
+    healthy = status['tunnel'] != 'down'
+    status['status'] = 'ok' if healthy else 'down'
+    return jsonify(status), 200 if healthy else 503
+
+
+@health.route('/health/ready')
+def ready():
+    started = time.perf_counter()
+    ok, error = True, None
+    try:
+        ping()
+    except Exception as e:
+        ok, error = False, str(e)
+    body = {
+        'status': 'ready' if ok else 'not_ready',
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    if error:
+        body['error'] = error
+    return jsonify(body), 200 if ok else 503
+
+
+@health.route('/health/stats')
+def stats():
+    with _stats_lock:
+        age = time.time() - _stats_cache['at']
+        if _stats_cache['stats'] is None or age >= STATS_CACHE_SECONDS:
+            try:
+                _stats_cache['stats'] = table_stats()
+                _stats_cache['at'] = time.time()
+                age = 0.0
+            except Exception as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 500
+        return jsonify({
+            'tables': _stats_cache['stats'],
+            'cached_seconds_ago': round(age, 1),
+            'cache_seconds': STATS_CACHE_SECONDS,
+            'connection': tunnel_status()
+        })
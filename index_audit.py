@@ -0,0 +1,354 @@
+"""
+Index audit and migrations for the access paths the dashboard queries rely on.
+
+Compares information_schema.STATISTICS with REQUIRED_INDEXES, reports gaps with
+the EXPLAIN plan of a representative lookup, and applies the missing indexes as
+versioned, reversible migrations tracked in schema_migrations.
+
+    python index_audit.py audit               # report gaps (with EXPLAIN estimates)
+    python index_audit.py status              # applied / pending migrations
+    python index_audit.py migrate [--dry-run] # create missing indexes
+    python index_audit.py rollback --to 3     # revert migrations above version 3
+"""
+import argparse
+import json
+
+
+# An existing index covers a requirement when the required columns are a leftmost
+# prefix of it. `explain` is a representative lookup of the dashboard queries.
+REQUIRED_INDEXES = [
+    {
+        'version': 1,
+        'table': 'hf_encounter',
+        'columns': ('patient_id', 'admitted_dt_tm'),
+        'used_by': 'patient filter + date ordering of every dashboard1 query, seek of the encounter and diagnosis pages',
+        'explain': "SELECT encounter_id FROM hf_encounter WHERE patient_id = 0 ORDER BY admitted_dt_tm DESC",
+    },
+    {
+        'version': 2,
+        'table': 'hf_encounter',
+        'columns': ('encounter_id',),
+        'used_by': 'join target of hf_medication / hf_diagnosis / hf_clinical_event',
+        'explain': "SELECT patient_id FROM hf_encounter WHERE encounter_id = 0",
+    },
+    {
+        'version': 3,
+        'table': 'hf_medication',
+        'columns': ('encounter_id',),
+        'used_by': 'hf_medication -> hf_encounter join (dashboard1, dashboard2, mme timeline)',
+        'explain': "SELECT medication_row_id FROM hf_medication WHERE encounter_id = 0",
+    },
+    {
+        'version': 4,
+        'table': 'hf_medication',
+        'columns': ('medication_row_id',),
+        'used_by': 'MME backfill checkpoint scan, t_MME join',
+        'explain': "SELECT encounter_id FROM hf_medication WHERE medication_row_id > 0 ORDER BY medication_row_id LIMIT 1",
+    },
+    {
+        'version': 5,
+        'table': 'hf_diagnosis',
+        'columns': ('encounter_id', 'diagnosis_priority'),
+        'used_by': 'primary diagnosis join of dashboard2, diagnosis summaries',
+        'explain': "SELECT diagnosis_code FROM hf_diagnosis WHERE encounter_id = 0 AND diagnosis_priority = 1",
+    },
+    {
+        'version': 6,
+        'table': 'hf_clinical_event',
+        # event_code_desc is matched with a leading wildcard, which no index can seek on
+        # (and it may be TEXT or too long to index), so only the join column is indexed
+        'columns': ('encounter_id',),
+        'used_by': 'pain score subquery of dashboard2',
+        'explain': "SELECT MAX(result_value_num) FROM hf_clinical_event "
+                   "WHERE encounter_id = 0 AND event_code_desc LIKE '%Pain Score%'",
+    },
+    {
+        'version': 7,
+        'table': 't_prediction_od',
+        'columns': ('patient_id',),
+        'used_by': 'overdose prediction join of dashboard2',
+        'explain': "SELECT label FROM t_prediction_od WHERE patient_id = 0",
+    },
+    {
+        'version': 8,
+        'table': 't_prediction_oud',
+        'columns': ('patient_id',),
+        'used_by': 'OUD prediction join of dashboard2',
+        'explain': "SELECT label FROM t_prediction_oud WHERE patient_id = 0",
+    },
+    {
+        'version': 9,
+        'table': 't_patient',
+        'columns': ('patient_id',),
+        'used_by': 'patient lookup of dashboard2',
+        'explain': "SELECT race FROM t_patient WHERE patient_id = 0",
+    },
+    {
+        'version': 10,
+        'table': 't_MME',
+        'columns': ('medication_row_id',),
+        'used_by': 'stored MME join of dashboard2 (normally created by mme_backfill.py)',
+        'explain': "SELECT mme_score FROM t_MME WHERE medication_row_id = 0",
+    },
+]
+
+MIGRATIONS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name VARCHAR(64) NOT NULL,
+        table_name VARCHAR(64) NOT NULL,
+        index_name VARCHAR(64) NOT NULL,
+        created TINYINT NOT NULL,
+        applied_at DATETIME NOT NULL
+    )
+"""
+
+
+def index_name(requirement):
+    name = 'idx_{}_{}'.format(requirement['table'].lower(), '_'.join(requirement['columns']))
+    return name[:64]
+
+
+def _query(conn, sql, params=None):
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def existing_indexes(conn):
+    """{table: {index name: [columns in order]}} for the current schema"""
+    rows = _query(conn, """
+        SELECT TABLE_NAME as table_name, INDEX_NAME as index_name, COLUMN_NAME as column_name
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE()
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+    """)
+    indexes = {}
+    for row in rows:
+        table = indexes.setdefault(row['table_name'].lower(), {})
+        table.setdefault(row['index_name'], []).append(row['column_name'].lower())
+    return indexes
+
+
+def table_rows(conn):
+    rows = _query(conn, """
+        SELECT TABLE_NAME as table_name, TABLE_ROWS as approx_rows
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE()
+    """)
+    return {row['table_name'].lower(): int(row['approx_rows'] or 0) for row in rows}
+
+
+def table_columns(conn):
+    """{table: set of column names} for the current schema"""
+    rows = _query(conn, """
+        SELECT TABLE_NAME as table_name, COLUMN_NAME as column_name
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+    """)
+    columns = {}
+    for row in rows:
+        columns.setdefault(row['table_name'].lower(), set()).add(row['column_name'].lower())
+    return columns
+
+
+def missing_columns(columns, requirement):
+    present = columns.get(requirement['table'].lower(), set())
+    return [column for column in requirement['columns'] if column.lower() not in present]
+
+
+def covering_index(indexes, requirement):
+    """Name of an existing index whose leftmost columns are the required ones, or None"""
+    required = [column.lower() for column in requirement['columns']]
+    for name, columns in indexes.get(requirement['table'].lower(), {}).items():
+        if columns[:len(required)] == required:
+            return name
+    return None
+
+
+def explain(conn, requirement):
+    try:
+        plan = _query(conn, 'EXPLAIN ' + requirement['explain'])
+    except Exception as e:
+        return {'error': str(e)}
+    row = plan[0] if plan else {}
+    return {
+        'access_type': row.get('type'),
+        'key': row.get('key'),
+        'estimated_rows': int(row.get('rows') or 0),
+        'filtered': float(row.get('filtered') or 100),
+        'extra': row.get('Extra'),
+    }
+
+
+def audit(conn, with_explain=True):
+    indexes = existing_indexes(conn)
+    approx_rows = table_rows(conn)
+    columns = table_columns(conn)
+    report = []
+    for requirement in REQUIRED_INDEXES:
+        table = requirement['table']
+        entry = {
+            'version': requirement['version'],
+            'table': table,
+            'columns': list(requirement['columns']),
+            'used_by': requirement['used_by'],
+        }
+        if table.lower() not in approx_rows:
+            entry['status'] = 'missing_table'
+            report.append(entry)
+            continue
+        if missing_columns(columns, requirement):
+            entry['status'] = 'missing_column'
+            entry['missing_columns'] = missing_columns(columns, requirement)
+            report.append(entry)
+            continue
+
+        covered_by = covering_index(indexes, requirement)
+        entry['status'] = 'ok' if covered_by else 'missing'
+        entry['covered_by'] = covered_by
+        entry['table_rows'] = approx_rows[table.lower()]
+        if with_explain and not covered_by:
+            plan = explain(conn, requirement)
+            entry['explain'] = plan
+            if plan.get('access_type') == 'ALL':
+                entry['impact'] = f"full scan of ~{plan['estimated_rows']} rows per lookup"
+            elif 'estimated_rows' in plan:
+                entry['impact'] = f"~{plan['estimated_rows']} rows examined per lookup via {plan['key'] or 'no index'}"
+        report.append(entry)
+    return report
+
+
+def ensure_migrations_table(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(MIGRATIONS_TABLE_DDL)
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def applied_migrations(conn):
+    ensure_migrations_table(conn)
+    return {row['version']: row for row in _query(conn, "SELECT * FROM schema_migrations ORDER BY version")}
+
+
+def migrate(conn, dry_run=False):
+    """Apply pending migrations in version order; already covered requirements are recorded without DDL"""
+    applied = applied_migrations(conn)
+    indexes = existing_indexes(conn)
+    tables = table_rows(conn)
+    columns = table_columns(conn)
+    done = []
+    for requirement in sorted(REQUIRED_INDEXES, key=lambda r: r['version']):
+        if requirement['version'] in applied:
+            continue
+        if requirement['table'].lower() not in tables:
+            done.append({'version': requirement['version'], 'action': 'skipped (table does not exist)'})
+            continue
+        if missing_columns(columns, requirement):
+            # Left pending, e.g. t_MME.medication_row_id until mme_backfill.py has run
+            done.append({'version': requirement['version'],
+                         'action': 'skipped (missing column {})'.format(', '.join(missing_columns(columns, requirement)))})
+            continue
+
+        covered_by = covering_index(indexes, requirement)
+        name = covered_by or index_name(requirement)
+        sql = None
+        if not covered_by:
+            sql = 'CREATE INDEX {} ON {} ({})'.format(name, requirement['table'], ', '.join(requirement['columns']))
+        done.append({'version': requirement['version'], 'action': sql or f'already covered by {covered_by}'})
+        if dry_run:
+            continue
+
+        cursor = conn.cursor()
+        try:
+            if sql:
+                cursor.execute(sql)
+                indexes.setdefault(requirement['table'].lower(), {})[name] = [c.lower() for c in requirement['columns']]
+            cursor.execute("""
+                INSERT INTO schema_migrations (version, name, table_name, index_name, created, applied_at)
+                VALUES (%s, %s, %s, %s, %s, NOW())
+            """, (requirement['version'], index_name(requirement), requirement['table'], name, 1 if sql else 0))
+            conn.commit()
+        except Exception as e:
+            # Left pending; the remaining migrations are independent of this one
+            done[-1]['error'] = str(e)
+        finally:
+            cursor.close()
+    return done
+
+
+def rollback(conn, to_version, dry_run=False):
+    """Revert applied migrations above `to_version`, newest first; only indexes we created are dropped"""
+    applied = applied_migrations(conn)
+    done = []
+    for version in sorted((v for v in applied if v > to_version), reverse=True):
+        migration = applied[version]
+        sql = None
+        if migration['created']:
+            sql = 'DROP INDEX {} ON {}'.format(migration['index_name'], migration['table_name'])
+        done.append({'version': version, 'action': sql or 'forget (index was not created by this tool)'})
+        if dry_run:
+            continue
+
+        cursor = conn.cursor()
+        try:
+            if sql:
+                cursor.execute(sql)
+            cursor.execute("DELETE FROM schema_migrations WHERE version = %s", (version,))
+            conn.commit()
+        except Exception as e:
+            # Stop here so the applied versions stay contiguous
+            done[-1]['error'] = str(e)
+            break
+        finally:
+            cursor.close()
+    return done
+
+
+def status(conn):
+    applied = applied_migrations(conn)
+    return [
+        {
+            'version': requirement['version'],
+            'name': index_name(requirement),
+            'applied_at': applied[requirement['version']]['applied_at'].isoformat()
+            if requirement['version'] in applied else None,
+        }
+        for requirement in REQUIRED_INDEXES
+    ]
+
+
+if __name__ == '__main__':
+    from db import get_db_connection
+
+    parser = argparse.ArgumentParser(description='Audit and migrate the indexes the dashboards rely on')
+    commands = parser.add_subparsers(dest='command', required=True)
+    audit_parser = commands.add_parser('audit', help='Report missing indexes')
+    audit_parser.add_argument('--no-explain', action='store_true', help='Skip EXPLAIN of the gaps')
+    commands.add_parser('status', help='Show applied and pending migrations')
+    migrate_parser = commands.add_parser('migrate', help='Create missing indexes')
+    migrate_parser.add_argument('--dry-run', action='store_true')
+    rollback_parser = commands.add_parser('rollback', help='Revert migrations above a version')
+    rollback_parser.add_argument('--to', type=int, required=True, dest='to_version')
+    rollback_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.command == 'audit':
+            result = audit(conn, with_explain=not args.no_explain)
+        elif args.command == 'status':
+            result = status(conn)
+        elif args.command == 'migrate':
+            result = migrate(conn, args.dry_run)
+        else:
+            result = rollback(conn, args.to_version, args.dry_run)
+    finally:
+        conn.close()
+
+    print(json.dumps(result, indent=2, default=str))
@@ -0,0 +1,252 @@
+"""
+Population-wide MME backfill.
+
+Streams every opioid row of hf_medication in medication_row_id order, computes its
+daily MME and upserts it into t_MME (one row per medication) with multi-row inserts,
+so dashboard2 only has to read stored values at request time.
+
+The last committed medication_row_id is checkpointed after every chunk: re-running
+the job resumes where it stopped, and running it again later only picks up new
+medications. --missing-only instead scans for medications that have no stored score.
+
+    python mme_backfill.py
+    python mme_backfill.py --chunk-size 10000
+    python mme_backfill.py --missing-only
+    python mme_backfill.py --reset            # start over from the first medication
+    python mme_backfill.py --show-schema-changes
+    python mme_backfill.py --migrate-schema   # first run: prepare t_MME (see below)
+
+t_MME needs a medication_row_id column with a unique key, and no unique key on
+encounter_id that leaves medication_row_id out. The job refuses to run until those are in place, and only
+changes the table when --migrate-schema is given.
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+from functools import lru_cache
+
+
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', 'mme_backfill.checkpoint.json')
+
+CHUNK_SIZE = 5000
+
+OPIOID_REGEXP = 'TRAMADOL|CODEINE|HYDROCODONE|OXYCODONE|MORPHINE|FENTANYL|HYDROMORPHONE|METHADONE'
+
+SOURCE_QUERY = """
+    SELECT
+        m.medication_row_id,
+        m.encounter_id,
+        m.generic_name,
+        m.order_strength,
+        m.frequency_desc
+    FROM hf_medication m
+    {join}
+    WHERE m.medication_row_id > %s
+    AND m.generic_name IS NOT NULL
+    AND m.generic_name REGEXP %s
+    {missing}
+    ORDER BY m.medication_row_id
+"""
+
+UPSERT_QUERY = """
+    INSERT INTO t_MME (encounter_id, medication_row_id, mme_score)
+    VALUES {values}
+    ON DUPLICATE KEY UPDATE
+        encounter_id = VALUES(encounter_id),
+        mme_score = VALUES(mme_score)
+"""
+
+
+def unique_keys(cursor):
+    """{index name: [columns in order]} of the unique keys of t_MME"""
+    cursor.execute("""
+        SELECT INDEX_NAME, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 't_MME' AND NON_UNIQUE = 0
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+    """)
+    keys = {}
+    for name, column in cursor.fetchall():
+        keys.setdefault(name, []).append(column.lower())
+    return keys
+
+
+def pending_schema_changes(conn):
+    """
+    DDL t_MME still needs to hold one score per medication row:
+    - a medication_row_id column with a unique key, which the upsert relies on
+    - unique keys that include encounter_id but not medication_row_id relaxed to
+      plain indexes; with one of those in place, ON DUPLICATE KEY UPDATE would
+      overwrite the score of another medication of the same encounter
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 't_MME' AND COLUMN_NAME = 'medication_row_id'
+        """)
+        has_column = cursor.fetchone()[0] > 0
+        keys = unique_keys(cursor)
+    finally:
+        cursor.close()
+
+    changes = []
+    if not has_column:
+        changes.append('ALTER TABLE t_MME ADD COLUMN medication_row_id BIGINT NULL, '
+                       'ADD UNIQUE KEY uq_t_mme_medication_row_id (medication_row_id)')
+    elif ['medication_row_id'] not in keys.values():
+        changes.append('ALTER TABLE t_MME ADD UNIQUE KEY uq_t_mme_medication_row_id (medication_row_id)')
+
+    for name, columns in keys.items():
+        if 'encounter_id' not in columns or 'medication_row_id' in columns:
+            continue
+        if name == 'PRIMARY':
+            changes.append('ALTER TABLE t_MME DROP PRIMARY KEY, ADD INDEX idx_t_mme_{} ({})'.format(
+                '_'.join(columns), ', '.join(columns)))
+        else:
+            changes.append('ALTER TABLE t_MME DROP INDEX `{0}`, ADD INDEX `{0}` ({1})'.format(
+                name, ', '.join(columns)))
+    return changes
+
+
+def ensure_schema(conn, migrate=False):
+    """
+    Check t_MME before writing to it. The DDL changes a shared table, so it only
+    runs with migrate=True (--migrate-schema); otherwise a RuntimeError lists it.
+    """
+    changes = pending_schema_changes(conn)
+    if not changes:
+        return []
+    if not migrate:
+        raise RuntimeError('t_MME is not ready for per-medication scores. Review the statements below and '
+                           're-run with --migrate-schema to apply them:\n  ' + ';\n  '.join(changes))
+
+    cursor = conn.cursor()
+    try:
+        for sql in changes:
+            print(f"Applying: {sql}")
+            cursor.execute(sql)
+        conn.commit()
+    finally:
+        cursor.close()
+    return changes
+
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f).get('last_medication_row_id', 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def save_checkpoint(last_id, processed, path=CHECKPOINT_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'last_medication_row_id': last_id,
+            'rows_processed': processed,
+            'updated_at': datetime.now().isoformat()
+        }, f)
+    os.replace(tmp_path, path)
+
+
+def compute_chunk(rows, calculate_daily_mme):
+    """(encounter_id, medication_row_id, mme_score) for a chunk of source rows"""
+    return [
+        (encounter_id, medication_row_id, calculate_daily_mme(strength, frequency, generic_name))
+        for medication_row_id, encounter_id, generic_name, strength, frequency in rows
+    ]
+
+
+def upsert_chunk(conn, values):
+    cursor = conn.cursor()
+    try:
+        query = UPSERT_QUERY.format(values=', '.join(['(%s, %s, %s)'] * len(values)))
+        cursor.execute(query, [v for row in values for v in row])
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def run_backfill(get_connection, calculate_daily_mme, chunk_size=CHUNK_SIZE,
+                 missing_only=False, reset=False, checkpoint_path=CHECKPOINT_PATH, migrate_schema=False):
+    # The same strength/frequency/drug combinations repeat across the population
+    score = lru_cache(maxsize=65536)(calculate_daily_mme)
+
+    write_conn = get_connection()
+    try:
+        ensure_schema(write_conn, migrate_schema)
+    except Exception:
+        write_conn.close()
+        raise
+
+    last_id = 0 if (reset or missing_only) else load_checkpoint(checkpoint_path)
+    if missing_only:
+        query = SOURCE_QUERY.format(
+            join='LEFT JOIN t_MME mme ON mme.medication_row_id = m.medication_row_id',
+            missing='AND mme.medication_row_id IS NULL'
+        )
+    else:
+        query = SOURCE_QUERY.format(join='', missing='')
+
+    # Server-side (unbuffered) cursor on its own connection; writes go through the other one
+    read_conn = cursor = None
+    processed = 0
+    try:
+        read_conn = get_connection()
+        cursor = read_conn.cursor(buffered=False)
+        cursor.execute(query, (last_id, OPIOID_REGEXP))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            upsert_chunk(write_conn, compute_chunk(rows, score))
+            processed += len(rows)
+            last_id = rows[-1][0]
+            if not missing_only:
+                save_checkpoint(last_id, processed, checkpoint_path)
+            print(f"Backfilled {processed} medications (up to medication_row_id {last_id})")
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if read_conn is not None:
+            read_conn.close()
+        write_conn.close()
+
+    return processed
+
+
+if __name__ == '__main__':
+    from db import get_db_connection
+    from dashboard2 import calculate_daily_mme
+
+    parser = argparse.ArgumentParser(description='Backfill daily MME scores into t_MME')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--missing-only', action='store_true',
+                        help='Only score medications without a stored score (ignores the checkpoint)')
+    parser.add_argument('--reset', action='store_true', help='Ignore the checkpoint and start from the beginning')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--migrate-schema', action='store_true',
+                        help='Apply the t_MME column/key changes the backfill needs (see --show-schema-changes)')
+    parser.add_argument('--show-schema-changes', action='store_true',
+                        help='Print the pending t_MME DDL and exit without changing anything')
+    args = parser.parse_args()
+
+    if args.show_schema_changes:
+        conn = get_db_connection()
+        try:
+            changes = pending_schema_changes(conn)
+        finally:
+            conn.close()
+        print('\n'.join(changes) if changes else 't_MME is up to date')
+        raise SystemExit(0)
+
+    try:
+        total = run_backfill(get_db_connection, calculate_daily_mme, args.chunk_size,
+                             args.missing_only, args.reset, args.checkpoint, args.migrate_schema)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    print(f"Done, {total} medications scored")
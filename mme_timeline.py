@@ -0,0 +1,186 @@
+"""
+Cumulative (concurrent) MME timeline.
+
+Each prescription contributes its daily MME from the day it was started through the
+day it was stopped. Summing those intervals per patient gives the total concurrent
+MME, which is what the >=50 / >=90 thresholds are meant for.
+
+The engine is a sweep line: every interval becomes a +mme event on its first day and
+a -mme event on the day after its last day, events are sorted by (patient, day) and
+a running sum gives the level at each change point. It is vectorized with NumPy so
+many patients are processed in one O(n log n) pass.
+"""
+from datetime import date, datetime
+
+import numpy as np
+
+
+MME_THRESHOLDS = (50, 90)
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+def _to_day(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.fromisoformat(str(value)).date()
+
+
+def intervals_from_rows(rows, as_of=None):
+    """
+    Turn prescription rows (patient_id, med_started_dt_tm, med_stopped_dt_tm, daily_mme)
+    into interval arrays as known on `as_of` (default today): prescriptions started
+    later are left out, and open or later-stopped ones are cut off at `as_of`.
+    """
+    as_of = as_of or date.today()
+    patient_ids, starts, stops, mme = [], [], [], []
+    for row in rows:
+        start = _to_day(row.get('med_started_dt_tm'))
+        daily_mme = row.get('daily_mme') or 0
+        if start is None or daily_mme <= 0 or start > as_of:
+            continue
+        stop = min(_to_day(row.get('med_stopped_dt_tm')) or as_of, as_of)
+        patient_ids.append(row['patient_id'])
+        starts.append(start)
+        stops.append(max(stop, start))
+        mme.append(daily_mme)
+
+    return (np.array(patient_ids, dtype=np.int64),
+            np.array(starts, dtype='datetime64[D]'),
+            np.array(stops, dtype='datetime64[D]'),
+            np.array(mme, dtype=np.float64))
+
+
+def build_timeline(patient_ids, starts, stops, daily_mme):
+    """
+    Sweep the intervals (stop day inclusive) into change points.
+
+    Returns a dict of equal-length arrays sorted by (patient_id, day): the level in
+    `total_mme` / `active_prescriptions` holds from `day` until the patient's next
+    change point. Each patient's last change point is the day the last
+    prescription ended, with a level of 0.
+    """
+    n = len(patient_ids)
+    if n == 0:
+        return {
+            'patient_id': np.empty(0, dtype=np.int64),
+            'day': np.empty(0, dtype='datetime64[D]'),
+            'total_mme': np.empty(0, dtype=np.float64),
+            'active_prescriptions': np.empty(0, dtype=np.int64)
+        }
+
+    event_pid = np.concatenate([patient_ids, patient_ids])
+    event_day = np.concatenate([starts, stops + ONE_DAY])
+    event_mme = np.concatenate([daily_mme, -daily_mme])
+    event_count = np.concatenate([np.ones(n, dtype=np.int64), -np.ones(n, dtype=np.int64)])
+
+    order = np.lexsort((event_day.astype(np.int64), event_pid))
+    event_pid = event_pid[order]
+    event_day = event_day[order]
+
+    # One running sum over all sorted events, re-based at each patient's first event
+    first = np.flatnonzero(np.r_[True, event_pid[1:] != event_pid[:-1]])
+    group_sizes = np.diff(np.r_[first, len(event_pid)])
+    running_mme = np.cumsum(event_mme[order])
+    running_count = np.cumsum(event_count[order])
+    level = np.round(running_mme - np.repeat(np.r_[0.0, running_mme][first], group_sizes), 2)
+    active = running_count - np.repeat(np.r_[0, running_count][first], group_sizes)
+
+    # Several events on the same (patient, day) collapse into the level after the last one
+    last_of_day = np.ones(len(event_pid), dtype=bool)
+    last_of_day[:-1] = (event_pid[1:] != event_pid[:-1]) | (event_day[1:] != event_day[:-1])
+    event_pid, event_day = event_pid[last_of_day], event_day[last_of_day]
+    level, active = level[last_of_day], active[last_of_day]
+
+    # Drop change points that do not change anything (e.g. a refill starting the day after the last one ended)
+    changed = np.ones(len(event_pid), dtype=bool)
+    changed[1:] = ((event_pid[1:] != event_pid[:-1])
+                   | (level[1:] != level[:-1])
+                   | (active[1:] != active[:-1]))
+
+    return {
+        'patient_id': event_pid[changed],
+        'day': event_day[changed],
+        'total_mme': level[changed],
+        'active_prescriptions': active[changed]
+    }
+
+
+def summarize_timeline(timeline, thresholds=MME_THRESHOLDS):
+    """Per-patient peak concurrent MME and number of days at or above each threshold"""
+    pids = timeline['patient_id']
+    if len(pids) == 0:
+        return {}
+
+    first = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]])
+    days = timeline['day']
+    level = timeline['total_mme']
+
+    # Length of each segment in days; the last change point of a patient is the 0 level
+    duration = np.zeros(len(pids), dtype=np.int64)
+    same_patient = pids[1:] == pids[:-1]
+    duration[:-1] = np.where(same_patient, (days[1:] - days[:-1]).astype(np.int64), 0)
+
+    peak = np.maximum.reduceat(level, first)
+    result = {
+        'peak_mme': peak,
+        'first_day': days[first],
+        'last_day': np.append(days[first[1:] - 1], days[-1]) - ONE_DAY
+    }
+    for threshold in thresholds:
+        above = np.where(level >= threshold, duration, 0)
+        result[f'days_mme_{threshold}'] = np.add.reduceat(above, first)
+
+    summary = {}
+    for i, patient_id in enumerate(pids[first].tolist()):
+        summary[patient_id] = {
+            'peak_mme': float(result['peak_mme'][i]),
+            'first_day': str(result['first_day'][i]),
+            'last_day': str(result['last_day'][i])
+        }
+        for threshold in thresholds:
+            summary[patient_id][f'days_mme_{threshold}'] = int(result[f'days_mme_{threshold}'][i])
+    return summary
+
+
+def timeline_rows(timeline, summary, daily=False, thresholds=MME_THRESHOLDS):
+    """
+    Flatten a timeline into Tableau rows with the patient summary repeated as columns.
+    With daily=True every day gets a row, otherwise only change points do. The
+    moderate/high flags use the lowest/highest of `thresholds`, like the summary.
+    """
+    moderate, high = min(thresholds), max(thresholds)
+    pids = timeline['patient_id']
+    days = timeline['day']
+    level = timeline['total_mme']
+    active = timeline['active_prescriptions']
+
+    if daily and len(pids):
+        duration = np.ones(len(pids), dtype=np.int64)
+        same_patient = pids[1:] == pids[:-1]
+        duration[:-1] = np.where(same_patient, (days[1:] - days[:-1]).astype(np.int64), 1)
+        # The closing 0-level point of each patient is not a day on therapy
+        duration[np.r_[~same_patient, True]] = 0
+        index = np.repeat(np.arange(len(pids)), duration)
+        offsets = np.arange(len(index)) - np.repeat(np.cumsum(duration) - duration, duration)
+        pids, level, active = pids[index], level[index], active[index]
+        days = days[index] + offsets.astype('timedelta64[D]')
+
+    rows = []
+    for patient_id, day, total_mme, count in zip(pids.tolist(), days.astype(str).tolist(),
+                                                 level.tolist(), active.tolist()):
+        row = {
+            'patient_id': patient_id,
+            'date': day,
+            'total_mme': total_mme,
+            'active_prescriptions': count,
+            'high_mme_flag': 1 if total_mme >= high else 0,
+            'moderate_mme_flag': 1 if total_mme >= moderate else 0
+        }
+        row.update(summary.get(patient_id, {}))
+        rows.append(row)
+    return rows
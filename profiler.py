@@ -0,0 +1,246 @@
+"""
+Bulk data-quality profiler.
+
+Makes one streaming pass per table (instead of probing one patient at a time
+through /api/diagnose) and writes a JSON report that dashboard1 serves from
+/api/profile/summary.
+
+    python profiler.py                    # full scan, sampled for very large tables
+    python profiler.py --sample-rate 0.1  # force a 10% sample everywhere
+"""
+import argparse
+import json
+import os
+from collections import Counter
+from datetime import datetime
+from decimal import Decimal
+
+
+PROFILE_TABLES = ['hf_encounter', 'hf_medication', 'hf_diagnosis']
+
+OPIOID_PATTERNS = ['oxycodone', 'hydrocodone', 'morphine', 'fentanyl', 'codeine', 'tramadol']
+
+REPORT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', 'data_quality.json')
+
+# Tables with more (estimated) rows than this are sampled down to roughly this many rows
+# unless an explicit sample rate is given.
+LARGE_TABLE_ROWS = 1000000
+FETCH_BATCH_SIZE = 5000
+TOP_N = 10
+# Columns with more distinct values than this (ids, timestamps) stop being counted
+# so a single pass stays bounded in memory.
+DISTINCT_CAP = 50000
+
+_summary_cache = {'mtime': None, 'summary': None}
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def is_opioid_name(name):
+    if not name:
+        return False
+    name = name.lower()
+    return any(pattern in name for pattern in OPIOID_PATTERNS)
+
+
+def estimate_row_count(conn, table):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT TABLE_ROWS FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (table,))
+        row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+    finally:
+        cursor.close()
+
+
+def choose_sample_rate(estimated_rows, sample_rate=None):
+    if sample_rate is not None:
+        return max(0.0, min(float(sample_rate), 1.0))
+    if estimated_rows > LARGE_TABLE_ROWS:
+        return LARGE_TABLE_ROWS / float(estimated_rows)
+    return 1.0
+
+
+def profile_table(conn, table, sample_rate=None):
+    """Stream every (or a sampled subset of) row of `table` once and collect column stats"""
+    estimated_rows = estimate_row_count(conn, table)
+    rate = choose_sample_rate(estimated_rows, sample_rate)
+
+    query = f"SELECT * FROM {table}"
+    params = None
+    if rate < 1.0:
+        query += " WHERE RAND() < %s"
+        params = (rate,)
+
+    # Unbuffered cursor: rows are pulled from the server as we go instead of all at once
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        columns = list(cursor.column_names)
+        nulls = [0] * len(columns)
+        values = [Counter() for _ in columns]
+        capped = [False] * len(columns)
+        unmatched = Counter()
+        generic_idx = columns.index('generic_name') if 'generic_name' in columns else None
+        rows_scanned = 0
+
+        while True:
+            batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                break
+            rows_scanned += len(batch)
+            for row in batch:
+                for i, value in enumerate(row):
+                    if value is None:
+                        nulls[i] += 1
+                    elif not capped[i]:
+                        # BLOB/binary columns come back as (unhashable) bytearray
+                        if isinstance(value, bytearray):
+                            value = bytes(value)
+                        values[i][value] += 1
+                if generic_idx is not None:
+                    name = row[generic_idx]
+                    if name and not is_opioid_name(name):
+                        unmatched[name] += 1
+            for i, counter in enumerate(values):
+                if not capped[i] and len(counter) > DISTINCT_CAP:
+                    capped[i] = True
+                    values[i] = Counter()
+    finally:
+        cursor.close()
+
+    column_stats = {}
+    for i, column in enumerate(columns):
+        column_stats[column] = {
+            'null_count': nulls[i],
+            'null_rate': round(nulls[i] / rows_scanned, 4) if rows_scanned else 0.0,
+            'distinct_count': None if capped[i] else len(values[i]),
+            'high_cardinality': capped[i],
+            'top_values': [] if capped[i] else [
+                {'value': _json_value(v), 'count': c} for v, c in values[i].most_common(TOP_N)
+            ]
+        }
+
+    result = {
+        'estimated_rows': estimated_rows,
+        'rows_scanned': rows_scanned,
+        'sample_rate': round(rate, 6),
+        'columns': column_stats
+    }
+    if generic_idx is not None:
+        result['unmatched_generic_names'] = {
+            'distinct_count': len(unmatched),
+            'row_count': sum(unmatched.values()),
+            'top_values': [{'value': v, 'count': c} for v, c in unmatched.most_common(TOP_N * 5)]
+        }
+    return result
+
+
+def encounter_coverage(conn):
+    """Encounters that have no medication and/or no diagnosis rows"""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT
+                COUNT(*) as total_encounters,
+                COALESCE(SUM(NOT EXISTS (SELECT 1 FROM hf_medication m WHERE m.encounter_id = e.encounter_id)), 0) as without_medications,
+                COALESCE(SUM(NOT EXISTS (SELECT 1 FROM hf_diagnosis d WHERE d.encounter_id = e.encounter_id)), 0) as without_diagnoses
+            FROM hf_encounter e
+        """)
+        row = cursor.fetchone() or {}
+        return {key: int(value or 0) for key, value in row.items()}
+    finally:
+        cursor.close()
+
+
+def run_profile(get_connection, sample_rate=None, report_path=REPORT_PATH):
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'opioid_patterns': OPIOID_PATTERNS,
+        'tables': {},
+        'encounter_coverage': {}
+    }
+
+    # One connection per table: an unbuffered result set ties up its connection until drained
+    for table in PROFILE_TABLES:
+        conn = get_connection()
+        try:
+            report['tables'][table] = profile_table(conn, table, sample_rate)
+        finally:
+            conn.close()
+
+    conn = get_connection()
+    try:
+        report['encounter_coverage'] = encounter_coverage(conn)
+    finally:
+        conn.close()
+
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    os.replace(tmp_path, report_path)
+    return report
+
+
+def summarize(report):
+    tables = {}
+    for table, stats in report.get('tables', {}).items():
+        columns = stats.get('columns', {})
+        tables[table] = {
+            'rows_scanned': stats.get('rows_scanned', 0),
+            'estimated_rows': stats.get('estimated_rows', 0),
+            'sample_rate': stats.get('sample_rate', 1.0),
+            'null_rates': {c: s['null_rate'] for c, s in columns.items() if s['null_rate'] > 0},
+            'distinct_counts': {c: s['distinct_count'] for c, s in columns.items()}
+        }
+        if 'unmatched_generic_names' in stats:
+            unmatched = stats['unmatched_generic_names']
+            tables[table]['unmatched_generic_names'] = {
+                'distinct_count': unmatched['distinct_count'],
+                'row_count': unmatched['row_count'],
+                'top_values': unmatched['top_values'][:TOP_N]
+            }
+    return {
+        'generated_at': report.get('generated_at'),
+        'tables': tables,
+        'encounter_coverage': report.get('encounter_coverage', {})
+    }
+
+
+def load_summary(report_path=REPORT_PATH):
+    """Summary of the last report on disk, re-read only when the file changes"""
+    try:
+        mtime = os.path.getmtime(report_path)
+    except OSError:
+        return None
+    if _summary_cache['mtime'] != mtime:
+        with open(report_path) as f:
+            _summary_cache['summary'] = summarize(json.load(f))
+        _summary_cache['mtime'] = mtime
+    return _summary_cache['summary']
+
+
+if __name__ == '__main__':
+    from db import get_db_connection
+
+    parser = argparse.ArgumentParser(description='Profile data quality of the HF tables')
+    parser.add_argument('--sample-rate', type=float, default=None,
+                        help='Fraction of rows to scan (default: full scan, sampled above %d rows)' % LARGE_TABLE_ROWS)
+    parser.add_argument('--output', default=REPORT_PATH, help='Report file path')
+    args = parser.parse_args()
+
+    report = run_profile(get_db_connection, args.sample_rate, args.output)
+    print(json.dumps(summarize(report), indent=2, default=str))
+    print(f"Report written to {args.output}")
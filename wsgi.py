@@ -0,0 +1,22 @@
+"""
+Production entry point: all three dashboards in one WSGI application on one port.
+
+    /              dashboard1 (patient risk)
+    /dashboard2    dashboard2 (MME monitoring)
+    /dashboard3    dashboard3 (population opioid data)
+
+Run it under the pre-fork server with the settings in gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+import dashboard1
+import dashboard2
+import dashboard3
+
+
+application = DispatcherMiddleware(dashboard1.app, {
+    '/dashboard2': dashboard2.app,
+    '/dashboard3': dashboard3.app,
+})